@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+RESOLUTIONS = {"480p": "640x480", "720p": "1280x720", "1080p": "1920x1080"}
+
+def bench_config(resolution, args, root):
+    # missing options get picasso's defaults, these are the ones that make it run without hardware
+    return {
+        "resolution": resolution,
+        "fps": args.fps,
+        "camera_device": args.source,
+        "cameras": [],
+        "other_path": root,
+        "usb_mode": False,
+        "secure": False,
+        "virtual_camera": True,
+        "virtual_camera_backend": "null",
+        "recording_backend": "pipe",
+        "preroll_seconds": 0,
+        "capture_process": args.capture_process,
+        "frame_tracing": True,
+        "metadata_interval": 1.0,
+    }
+
+def thread_names():
+    return {thread.native_id: thread.name for thread in threading.enumerate()}
+
+def cpu_seconds(process):
+    times = process.cpu_times()
+    return times.user + times.system
+
+def run_worker(args):
+    """
+    One resolution, in its own process since picasso2 sets everything up when imported.
+    The preview is watched by one viewer the whole time, everything before the warmup
+    is over is left out
+    """
+    import picasso2
+    camera = picasso2.cameras.default
+    process = psutil.Process()
+    start = time.monotonic()
+    measure_start = start + args.warmup
+    end = measure_start + args.seconds
+    sample = {}
+    rss = {"max": 0, "children_max": 0}
+    preview_frames = 0
+
+    def sampler():
+        while time.monotonic() < end:
+            if not sample and time.monotonic() >= measure_start:
+                children = process.children(recursive=True)
+                sample.update({
+                    "time": time.monotonic(),
+                    "cpu": cpu_seconds(process),
+                    "children_cpu": sum(cpu_seconds(child) for child in children),
+                    "threads": {thread.id: thread.user_time + thread.system_time for thread in process.threads()},
+                    "capture_frames": camera.metrics.capture_frames.value,
+                    "output_frames": camera.metrics.output_frame_seconds.count,
+                    "output_skipped": camera.metrics.output_skipped_frames.value,
+                })
+            if sample:
+                rss["max"] = max(rss["max"], process.memory_info().rss)
+                rss["children_max"] = max(rss["children_max"], sum(child.memory_info().rss for child in process.children(recursive=True)))
+            time.sleep(0.25)
+
+    class Viewer:
+        async def is_disconnected(self):
+            return time.monotonic() >= end
+
+    async def watch_preview():
+        nonlocal preview_frames
+        async for _ in camera._get_web_stream(Viewer()):
+            if time.monotonic() >= measure_start:
+                preview_frames += 1
+
+    sampler_thread = threading.Thread(target=sampler, daemon=True)
+    sampler_thread.start()
+    asyncio.run(watch_preview())
+    sampler_thread.join()
+
+    seconds = time.monotonic() - sample["time"]
+    children = process.children(recursive=True)
+    children_cpu = sum(cpu_seconds(child) for child in children) - sample["children_cpu"]
+    process_cpu = cpu_seconds(process) - sample["cpu"]
+    names = thread_names()
+    by_thread = {}
+    for thread in process.threads():
+        used = thread.user_time + thread.system_time - sample["threads"].get(thread.id, 0)
+        # threads opencv and numpy start themselves have no python name
+        name = names.get(thread.id, "other")
+        by_thread[name] = by_thread.get(name, 0) + used * 100 / seconds
+    result = {
+        "resolution": picasso2.config["resolution"],
+        "seconds": round(seconds, 3),
+        "fps": {
+            "target": args.fps,
+            "capture": round((camera.metrics.capture_frames.value - sample["capture_frames"]) / seconds, 2),
+            "output": round((camera.metrics.output_frame_seconds.count - sample["output_frames"]) / seconds, 2),
+            "preview": round(preview_frames / seconds, 2),
+        },
+        "output_skipped_frames": camera.metrics.output_skipped_frames.value - sample["output_skipped"],
+        "capture_format": camera.capture_format,
+        "cpu_percent": {
+            "total": round((process_cpu + children_cpu) * 100 / seconds, 1),
+            "process": round(process_cpu * 100 / seconds, 1),
+            "children": round(children_cpu * 100 / seconds, 1),
+            "by_thread": {name: round(value, 1) for name, value in sorted(by_thread.items(), key=lambda item: -item[1]) if value >= 0.1},
+        },
+        "rss_bytes": {
+            "max": rss["max"],
+            "end": process.memory_info().rss,
+            "children_max": rss["children_max"],
+        },
+        "stages": camera.tracer.stage_stats(measure_start),
+    }
+    with open(args.result, "w") as f:
+        json.dump(result, f)
+    # the capture threads are still inside opencv calls, tearing the interpreter down
+    # under them aborts, so clean up what would be left behind and leave right away
+    for bench_camera in picasso2.cameras.cameras.values():
+        if bench_camera._capture:
+            bench_camera._capture.close()
+    sys.stdout.flush()
+    os._exit(0)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+def run_resolution(label, resolution, args):
+    root = tempfile.mkdtemp(prefix="picasso_bench_")
+    try:
+        config_path = os.path.join(root, "config.json")
+        with open(config_path, "w") as f:
+            json.dump(bench_config(resolution, args, root), f, indent=4)
+        result_path = os.path.join(root, "result.json")
+        command = [sys.executable, os.path.abspath(__file__), "--worker", "--result", result_path,
+                   "--seconds", str(args.seconds), "--warmup", str(args.warmup), "--fps", str(args.fps)]
+        # picasso logs to stdout, stdout is where the results go
+        subprocess.run(command, env={**os.environ, "PICASSO_CONFIG": config_path},
+                       stdout=sys.stderr if args.verbose else subprocess.DEVNULL, timeout=args.warmup + args.seconds + 120)
+        if not os.path.exists(result_path):
+            print(f"{label}: the benchmark process did not write results, rerun with --verbose", file=sys.stderr)
+            return None
+        with open(result_path, "r") as f:
+            result = json.load(f)
+        result["label"] = label
+        return result
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def compare(baseline, current):
+    # percent change of the numbers that matter, printed next to each other
+    def change(old, new):
+        if not old:
+            return ""
+        return f"{(new - old) * 100 / old:+.1f}%"
+    old_results = {result["label"]: result for result in baseline["results"]}
+    print(f"compared to {baseline.get('commit')} ({baseline.get('created')})", file=sys.stderr)
+    for result in current["results"]:
+        old = old_results.get(result["label"])
+        if old is None:
+            continue
+        rows = [
+            ("capture fps", old["fps"]["capture"], result["fps"]["capture"]),
+            ("preview fps", old["fps"]["preview"], result["fps"]["preview"]),
+            ("cpu %", old["cpu_percent"]["total"], result["cpu_percent"]["total"]),
+            ("max rss MB", old["rss_bytes"]["max"] / 1e6, result["rss_bytes"]["max"] / 1e6),
+        ]
+        for stage, stats in result["stages"].items():
+            old_stats = old["stages"].get(stage)
+            # read is where the time since capture starts, it is always 0
+            if stage != "read" and old_stats and old_stats["since_capture_ms"] and stats["since_capture_ms"]:
+                rows.append((f"{stage} p95 ms", old_stats["since_capture_ms"]["p95"], stats["since_capture_ms"]["p95"]))
+        print(f"{result['label']}:", file=sys.stderr)
+        for name, old_value, new_value in rows:
+            print(f"  {name:<24} {old_value:>10.2f} -> {new_value:>10.2f} {change(old_value, new_value)}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs capture -> resize -> virtual camera -> preview encode without any hardware and prints the results as JSON")
+    parser.add_argument("--resolutions", default="480p,720p,1080p", help=f"comma separated, {', '.join(RESOLUTIONS)} or WxH")
+    parser.add_argument("--seconds", type=float, default=10, help="measured seconds per resolution")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds left out at the start of each run")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--source", default="synthetic", help="synthetic, synthetic:WxH, synthetic:unpaced or file:/path/video.mp4, see picasso_sources.py")
+    parser.add_argument("--capture-process", action="store_true", help="capture in a separate process like config capture_process")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--verbose", action="store_true", help="show picasso's log")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    import cv2
+    report = {
+        "bench": "picasso",
+        "version": 1,
+        "commit": git_commit(),
+        "created": datetime.datetime.now().isoformat(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "source": args.source,
+        "fps": args.fps,
+        "seconds": args.seconds,
+        "warmup": args.warmup,
+        "capture_process": args.capture_process,
+        "results": [],
+    }
+    for label in args.resolutions.split(","):
+        label = label.strip()
+        resolution = RESOLUTIONS.get(label, label)
+        print(f"Benchmarking {label} ({resolution}) for {args.seconds}s...", file=sys.stderr)
+        result = run_resolution(label, resolution, args)
+        if result is not None:
+            report["results"].append(result)
+            print(f"  capture {result['fps']['capture']} fps, preview {result['fps']['preview']} fps, cpu {result['cpu_percent']['total']}%", file=sys.stderr)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
+from collections import deque
 from datetime import timedelta
 import shutil
 import signal
 import time
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, Response
 # cors
 from fastapi.middleware.cors import CORSMiddleware
 import json
@@ -17,8 +18,17 @@ from colorama import init
 import sys
 import cv2
 import threading
+import queue
 import asyncio
+import uuid
+import copy
+from concurrent.futures import ThreadPoolExecutor
 import psutil
+from picasso_media import MediaIndex, ThumbnailCache, prepare_playback
+from picasso_capture import CaptureProcess, FAILED_READS, FAILED_READS_TOTAL, CAMERA_REOPENS
+from picasso_metrics import MetricsRegistry, LATENCY_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from picasso_trace import FrameTracer, chrome_trace
+from picasso_sources import open_source, is_capture_device, NullVirtualCamera
 init()
 
 class Logger:
@@ -39,22 +49,50 @@ class Logger:
 
 LOGS = Logger("Picasso")
 # Get config or make if not present
-config_path = os.path.expanduser("~/.config/picasso/config.json")
+# PICASSO_CONFIG points somewhere else, bench.py runs the pipeline with its own config that way
+config_path = os.path.expanduser(os.environ.get("PICASSO_CONFIG", "~/.config/picasso/config.json"))
 default_config = {
     "resolution": "1280x720", # previews, recordings, pictures
     "fps": 30, # ffmpeg argument
-    "encoding_format": "libx264", # ffmpeg argument
+    "encoding_format": "auto", # ffmpeg encoder, "auto" picks a hardware h264 encoder when one works and libx264 otherwise
     "usb_mode": False, # Automatically save to plugged in USB storage device
     "usb_path": "/media/usb1",
     "other_path": "~/",
     "preview_quality": 25, # preview quality
-    "camera_device": "/dev/video0", # Default camera device
+    "preview_ladder": [ # preview variants clients step through on slow links, best first. quality null means preview_quality
+        {"scale": 0.5, "quality": None, "fps_divisor": 1},
+        {"scale": 0.375, "quality": 20, "fps_divisor": 1},
+        {"scale": 0.25, "quality": 15, "fps_divisor": 2},
+    ],
+    "camera_device": "/dev/video0", # Default camera device, "synthetic" or "file:/path/video.mp4" run without one (see picasso_sources.py)
+    "cameras": [], # for more than one capture device, [{"id": "front", "device": "/dev/video0"}, ...], each gets its own loopback (/dev/video40, 41, ... unless "virtual_device" is set). Empty uses camera_device
     "passcode": "1234", # simple passcode to stop/start recording and take pictures
     "secure": True, # if true, require passcode to stop/start recording and take pictures
     "virtual_device": {
         "name": "PicassoVirtCam",
         "device": "/dev/video40"
     },
+    "virtual_camera": True, # if false, no v4l2loopback device is created (requires recording_backend "pipe")
+    "virtual_camera_backend": "v4l2loopback", # "null" converts frames like pyvirtualcam but sends them nowhere, no modprobe needed (requires recording_backend "pipe")
+    "recording_backend": "loopback", # "loopback": ffmpeg reads the virtual camera, "pipe": raw frames are piped straight into ffmpeg
+    "encoder_profile": "balanced", # one of encoder_profiles
+    "encoder_profiles": { # preset and crf only apply to libx264, hardware encoders use bitrate and gop
+        "balanced": {"bitrate": "2048k", "preset": "veryfast", "gop": 60, "crf": None},
+        "quality": {"bitrate": "6000k", "preset": "faster", "gop": 60, "crf": 20},
+        "low_cpu": {"bitrate": "1500k", "preset": "ultrafast", "gop": 120, "crf": None},
+    },
+    "segment_seconds": 0, # if > 0, takes are split into segments of this many seconds inside a folder per take
+    "container": "mkv", # "mkv" or "mp4" (fragmented), both stay playable up to the last few seconds after a power cut
+    "faststart_remux": False, # with container "mp4", remux finished single file takes in the background into a regular mp4 with the index up front
+    "preroll_seconds": 0, # if > 0, keep this many seconds of encoded video in memory and put them at the start of every take
+    "preroll_max_bytes": 64 * 1024 * 1024, # memory cap for the pre-roll, oldest seconds are dropped first
+    "metadata_interval": 2.0, # seconds between memory/storage samples for /metadata
+    "h264_preview_scale": 0.5, # size of the /preview/ws h264 sub-stream relative to resolution
+    "h264_preview_bitrate": "800k",
+    "encode_workers": 2, # threads for saving pictures and bursts, keeps it off the server's event loop. The preview has its own
+    "burst_max_frames": 60, # most frames one /take_burst may hold in memory
+    "capture_process": False, # if true, each camera is read by its own process into shared memory, so a busy server never makes it miss frames
+    "frame_tracing": False, # if true, time every frame from capture to the virtual camera and preview viewers, see /trace and picasso_frame_latency_seconds in /metrics
 }
 config = None
 
@@ -87,16 +125,1168 @@ for key in config:
 for key in delkeys:
     del config[key]
 
+def save_config():
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=4)
+
 if update_config:
     try:
-        with open(config_path, "w") as f:
-            json.dump(config, f, indent=4)
+        save_config()
         LOGS.log(f"Updated config at {config_path} with missing default values")
     except Exception as e:
         LOGS.error(f"Failed to update config at {config_path}: {e}")
         sys.exit(1)
 
+# ffmpeg output args per container. Fragmented mp4 writes a self contained fragment at every
+# keyframe instead of one index at the end, so a cut off file is still playable
+CONTAINER_ARGS = {
+    "mkv": ["-f", "matroska"],
+    "mp4": ["-f", "mp4", "-movflags", "+frag_keyframe+empty_moov+default_base_moof"],
+}
+
+# preferred first, the pi 4 has a v4l2 m2m hardware encoder, older pis only have omx
+HARDWARE_ENCODERS = ["h264_v4l2m2m", "h264_omx"]
+
+def probe_encoders():
+    """
+    Returns the ffmpeg video encoders that can actually be used here. ffmpeg lists
+    hardware encoders it was built with even when the hardware is missing, so those
+    get a tiny test encode before being trusted
+    """
+    try:
+        output = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        LOGS.error(f"Failed to list ffmpeg encoders: {e}")
+        return []
+    encoders = []
+    for line in output.splitlines():
+        # " V....D libx264              libx264 H.264 / AVC ..."
+        parts = line.split()
+        # the legend at the top looks the same (" V..... = Video"), skip it
+        if len(parts) >= 2 and parts[0].startswith("V") and len(parts[0]) == 6 and parts[1] != "=":
+            encoders.append(parts[1])
+    usable = []
+    for name in encoders:
+        if name in HARDWARE_ENCODERS:
+            try:
+                test = subprocess.run([
+                    "ffmpeg", "-hide_banner", "-loglevel", "error",
+                    "-f", "lavfi", "-i", "testsrc=size=320x240:rate=30",
+                    "-frames:v", "5", "-pix_fmt", "yuv420p",
+                    "-c:v", name, "-f", "null", "-"
+                ], capture_output=True, timeout=10)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                # a driver that hangs is as unusable as one that fails
+                LOGS.warn(f"Test encode with {name} failed ({e}), skipping it")
+                continue
+            if test.returncode != 0:
+                LOGS.warn(f"ffmpeg has {name} but it does not work on this machine, skipping it")
+                continue
+        usable.append(name)
+    return usable
+
+def select_encoder(available):
+    if config["encoding_format"] != "auto":
+        if config["encoding_format"] not in available:
+            LOGS.warn(f"Configured encoder {config['encoding_format']} was not found in ffmpeg, trying it anyway")
+        return config["encoding_format"]
+    for name in HARDWARE_ENCODERS + ["libx264"]:
+        if name in available:
+            return name
+    LOGS.warn("No h264 encoder found in ffmpeg, falling back to libx264")
+    return "libx264"
+
+def encoder_args(encoder, profile):
+    args = ["-c:v", encoder, "-pix_fmt", "yuv420p", "-g", str(profile["gop"])]
+    if encoder == "libx264":
+        args += ["-preset", profile["preset"]]
+        if profile.get("crf") is not None:
+            # constant quality, capped so a busy scene cannot blow past the bitrate
+            args += ["-crf", str(profile["crf"]), "-maxrate", profile["bitrate"], "-bufsize", profile["bitrate"]]
+            return args
+    args += ["-b:v", profile["bitrate"]]
+    return args
+
+# /metrics, every family is labelled by camera so a multi camera setup can be told apart
+metrics = MetricsRegistry()
+CAPTURE_FRAMES = metrics.counter("picasso_capture_frames_total", "Frames read from the camera", ("camera",))
+CAPTURE_FPS = metrics.gauge("picasso_capture_fps", "Frames read from the camera per second over the last metadata_interval", ("camera",))
+CAPTURE_FAILED_READS = metrics.counter("picasso_capture_failed_reads_total", "Camera reads that returned no frame", ("camera",))
+CAPTURE_CONSECUTIVE_FAILED_READS = metrics.gauge("picasso_capture_consecutive_failed_reads", "Failed reads in a row, the camera is reopened at 10", ("camera",))
+CAPTURE_REOPENS = metrics.counter("picasso_capture_reopens_total", "Times the camera was reopened after failing", ("camera",))
+FOLLOWER_SKIPPED_FRAMES = metrics.counter("picasso_capture_process_skipped_frames_total", "Frames from the capture process the server never picked up", ("camera",))
+OUTPUT_SKIPPED_FRAMES = metrics.counter("picasso_output_skipped_frames_total", "Frames the output writer skipped because it fell behind the camera", ("camera",))
+OUTPUT_FRAME_SECONDS = metrics.histogram("picasso_output_frame_seconds", "Time on_frame spends on one frame (resize, virtual camera, encoder pipes)", ("camera",))
+RESIZE_SECONDS = metrics.histogram("picasso_resize_seconds", "Time spent resizing frames the camera delivered at the wrong size", ("camera",))
+VCAM_SEND_SECONDS = metrics.histogram("picasso_vcam_send_seconds", "Time spent sending a frame to the virtual camera", ("camera",))
+WRITER_DROPPED_FRAMES = metrics.counter("picasso_writer_dropped_frames_total", "Frames dropped because an ffmpeg encoder did not take them fast enough", ("camera", "encoder"))
+ENCODER_FRAMES = metrics.counter("picasso_encoder_frames_total", "Frames the recording ffmpeg has written", ("camera",))
+ENCODER_FPS = metrics.gauge("picasso_encoder_fps", "Frames per second of the running recording, as reported by ffmpeg", ("camera",))
+PREVIEW_ENCODE_SECONDS = metrics.histogram("picasso_preview_encode_seconds", "Time to resize and JPEG encode one preview frame", ("camera", "level"))
+PREVIEW_CLIENTS = metrics.gauge("picasso_preview_clients", "Connected preview viewers", ("camera", "stream"))
+PREVIEW_SENT_BYTES = metrics.counter("picasso_preview_sent_bytes_total", "Preview bytes handed to viewers", ("camera", "stream"))
+PREVIEW_CLIENT_SENT_BYTES = metrics.counter("picasso_preview_client_sent_bytes_total", "Preview bytes handed to each connected viewer", ("camera", "stream", "client"))
+PREVIEW_DROPPED_FRAMES = metrics.counter("picasso_preview_dropped_frames_total", "Preview frames (mjpeg) or fragments (h264) thrown away for viewers that were too slow", ("camera", "stream"))
+USB_COPIED_BYTES = metrics.counter("picasso_usb_copied_bytes_total", "Bytes copied from the temp folder to the USB drive", ("camera",))
+USB_COPY_SECONDS = metrics.counter("picasso_usb_copy_seconds_total", "Time spent copying to the USB drive, rate(bytes) / rate(seconds) is the throughput", ("camera",))
+ENCODE_POOL_PENDING = metrics.gauge("picasso_encode_pool_pending", "JPEG encodes queued or running", ("camera",))
+FRAME_LATENCY = metrics.histogram("picasso_frame_latency_seconds", "Time from a frame leaving the camera until a stage was done with it, only with frame_tracing", ("camera", "stage"), LATENCY_BUCKETS)
+
+class CameraMetrics:
+    """
+    A camera's children of the metric families above, looked up once here so the frame
+    loops only increment or observe
+    """
+    def __init__(self, camera_id):
+        self.camera_id = camera_id
+        self.capture_frames = CAPTURE_FRAMES.labels(camera_id)
+        self.capture_fps = CAPTURE_FPS.labels(camera_id)
+        self.capture_failed_reads = CAPTURE_FAILED_READS.labels(camera_id)
+        self.capture_consecutive_failed_reads = CAPTURE_CONSECUTIVE_FAILED_READS.labels(camera_id)
+        self.capture_reopens = CAPTURE_REOPENS.labels(camera_id)
+        self.follower_skipped_frames = FOLLOWER_SKIPPED_FRAMES.labels(camera_id)
+        self.output_skipped_frames = OUTPUT_SKIPPED_FRAMES.labels(camera_id)
+        self.output_frame_seconds = OUTPUT_FRAME_SECONDS.labels(camera_id)
+        self.resize_seconds = RESIZE_SECONDS.labels(camera_id)
+        self.vcam_send_seconds = VCAM_SEND_SECONDS.labels(camera_id)
+        self.recording_dropped_frames = WRITER_DROPPED_FRAMES.labels(camera_id, "recording")
+        self.preroll_dropped_frames = WRITER_DROPPED_FRAMES.labels(camera_id, "preroll")
+        self.h264_preview_dropped_frames = WRITER_DROPPED_FRAMES.labels(camera_id, "h264_preview")
+        self.encoder_frames = ENCODER_FRAMES.labels(camera_id)
+        self.encoder_fps = ENCODER_FPS.labels(camera_id)
+        self.mjpeg_clients = PREVIEW_CLIENTS.labels(camera_id, "mjpeg")
+        self.h264_clients = PREVIEW_CLIENTS.labels(camera_id, "h264")
+        self.mjpeg_sent_bytes = PREVIEW_SENT_BYTES.labels(camera_id, "mjpeg")
+        self.h264_sent_bytes = PREVIEW_SENT_BYTES.labels(camera_id, "h264")
+        self.mjpeg_dropped_frames = PREVIEW_DROPPED_FRAMES.labels(camera_id, "mjpeg")
+        self.h264_dropped_fragments = PREVIEW_DROPPED_FRAMES.labels(camera_id, "h264")
+        self.usb_copied_bytes = USB_COPIED_BYTES.labels(camera_id)
+        self.usb_copy_seconds = USB_COPY_SECONDS.labels(camera_id)
+        self.encode_pool_pending = ENCODE_POOL_PENDING.labels(camera_id)
+        self._last_sample = None
+
+    def preview_encode_seconds(self, level):
+        return PREVIEW_ENCODE_SECONDS.labels(self.camera_id, level)
+
+    def client_sent_bytes(self, stream, client_id):
+        return PREVIEW_CLIENT_SENT_BYTES.labels(self.camera_id, stream, client_id)
+
+    def remove_client(self, stream, client_id):
+        PREVIEW_CLIENT_SENT_BYTES.remove(self.camera_id, stream, client_id)
+
+    def sample(self):
+        # rates for the gauges, called on the metadata sampler's cadence
+        now = time.monotonic()
+        frames = self.capture_frames.value
+        if self._last_sample is not None:
+            last_time, last_frames = self._last_sample
+            if now > last_time:
+                self.capture_fps.set((frames - last_frames) / (now - last_time))
+        self._last_sample = (now, frames)
+
+# global options, ffmpeg prints key=value blocks about twice a second instead of its status line
+PROGRESS_ARGS = ["-nostats", "-progress", "pipe:1"]
+
+def follow_encoder_progress(proc: subprocess.Popen, camera_metrics: CameraMetrics):
+    """
+    Reads the -progress output of a recording ffmpeg (see PROGRESS_ARGS) into the
+    encoder metrics until it exits
+    """
+    last_frame = 0
+    for line in proc.stdout:
+        key, _, value = line.decode(errors="replace").strip().partition("=")
+        try:
+            if key == "frame":
+                frame = int(value)
+                camera_metrics.encoder_frames.inc(max(frame - last_frame, 0))
+                last_frame = frame
+            elif key == "fps":
+                camera_metrics.encoder_fps.set(float(value))
+        except ValueError:
+            pass # N/A before the first frame
+    camera_metrics.encoder_fps.set(0)
+
+class FrameNotifier:
+    """
+    Hands out a sequence number for every frame the capture thread produces and wakes
+    up anyone waiting for a newer one. Waiters can be plain threads or asyncio tasks
+    running on another event loop (the capture thread and uvicorn do not share one)
+    """
+    def __init__(self):
+        self.seq = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def publish(self):
+        with self._cond:
+            self.seq += 1
+            waiters = self._async_waiters
+            self._async_waiters = []
+            self._cond.notify_all()
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                pass # loop was closed while waiting
+        return self.seq
+
+    @staticmethod
+    def _wake(future: asyncio.Future):
+        if not future.done():
+            future.set_result(None)
+
+    def wait(self, last_seq, timeout=None):
+        # blocks the calling thread until a frame newer than last_seq exists
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq != last_seq, timeout)
+            return self.seq
+
+    async def wait_async(self, last_seq, timeout=None):
+        # same as wait() but for asyncio tasks, returns last_seq again on timeout
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.seq != last_seq:
+                return self.seq
+            waiter = (loop, loop.create_future())
+            self._async_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), timeout)
+        except asyncio.TimeoutError:
+            with self._cond:
+                if waiter in self._async_waiters:
+                    self._async_waiters.remove(waiter)
+        return self.seq
+
+class FrameRing:
+    """
+    Small ring of preallocated frame buffers that the capture thread reads straight into.
+    There is only one writer (the capture thread) and it always fills the slot after the
+    newest one, so a reader holding the latest frame has (size - 1) frame periods to use
+    it before it gets overwritten. Publishing a frame is a single attribute assignment,
+    readers never take a lock
+    """
+    def __init__(self, shape, size=4):
+        self.slots = [np.zeros(shape, dtype=np.uint8) for _ in range(size)]
+        self.latest = None
+        self._next_index = 0
+
+    def next_slot(self):
+        return self.slots[self._next_index]
+
+    def commit(self, frame: np.ndarray):
+        # cap.read only reuses our buffer if the camera frame has the same shape,
+        # if it handed back a new array keep that one so the next lap reuses it
+        if frame is not self.slots[self._next_index]:
+            self.slots[self._next_index] = frame
+        self.latest = frame
+        self._next_index = (self._next_index + 1) % len(self.slots)
+
+class RawFrameWriter:
+    """
+    Feeds raw BGR frames into an ffmpeg process' stdin from its own thread.
+    Frames are copied into a fixed pool of buffers, if ffmpeg falls behind and the pool
+    runs out the frame is dropped (and counted) instead of blocking the caller
+    """
+    def __init__(self, proc: subprocess.Popen, shape, pool_size=8, dropped_counter=None):
+        self.logger = Logger('RawFrameWriter')
+        self.proc = proc
+        self.dropped_frames = 0
+        self.dropped_counter = dropped_counter # shared across takes, for /metrics
+        self.written_frames = 0
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for _ in range(pool_size):
+            self._free.put(np.zeros(shape, dtype=np.uint8))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, frame: np.ndarray):
+        try:
+            buffer = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped_frames += 1
+            if self.dropped_counter is not None:
+                self.dropped_counter.inc()
+            return False
+        np.copyto(buffer, frame)
+        self._filled.put(buffer)
+        return True
+
+    def _run(self):
+        while True:
+            buffer = self._filled.get()
+            if buffer is None:
+                break
+            try:
+                self.proc.stdin.write(buffer.data)
+            except (BrokenPipeError, ValueError, OSError) as e:
+                self.logger.error(f"ffmpeg stopped accepting frames: {e}")
+                break
+            self.written_frames += 1
+            self._free.put(buffer)
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+    def close(self, timeout=10):
+        self._filled.put(None)
+        self._thread.join(timeout)
+
+class SegmentMover:
+    """
+    Follows ffmpeg's segment list while a segmented take records and moves every finished
+    segment from the temp folder into the take folder, so stopping only has to move the
+    last one. When the take is done it writes manifest.json next to the segments
+    """
+    def __init__(self, list_path, source_dir, take_dir, take_info, poll_interval=1.0, camera_metrics=None):
+        self.logger = Logger('SegmentMover')
+        self.camera_metrics = camera_metrics
+        self.list_path = list_path
+        self.source_dir = source_dir
+        self.take_dir = take_dir
+        self.take_info = take_info
+        self.poll_interval = poll_interval
+        self.segments = []
+        self.moved_bytes = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.poll_interval):
+            self._collect_finished()
+
+    def _collect_finished(self):
+        # ffmpeg appends "name,start,end" once a segment is closed
+        if not os.path.exists(self.list_path):
+            return
+        with open(self.list_path, "r") as f:
+            lines = f.readlines()
+        for line in lines[len(self.segments):]:
+            if not line.endswith("\n"):
+                break # ffmpeg is still writing this entry
+            name, start, end = line.strip().rsplit(",", 2)
+            name = os.path.basename(name)
+            target = os.path.join(self.take_dir, name)
+            moved = self.source_dir != self.take_dir
+            if moved:
+                move_start = time.perf_counter()
+                try:
+                    shutil.move(os.path.join(self.source_dir, name), target)
+                except Exception as e:
+                    self.logger.error(f"Failed to move segment {name} to {self.take_dir}: {e}")
+                    return
+                move_seconds = time.perf_counter() - move_start
+            size = os.path.getsize(target)
+            if moved and self.camera_metrics:
+                self.camera_metrics.usb_copied_bytes.inc(size)
+                self.camera_metrics.usb_copy_seconds.inc(move_seconds)
+            self.moved_bytes += size
+            self.segments.append({
+                "file": name,
+                "start": float(start),
+                "end": float(end),
+                "size_bytes": size,
+            })
+
+    def finish(self):
+        # call after ffmpeg exited so the last segment is in the list
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._collect_finished()
+        manifest = dict(self.take_info)
+        manifest["segments"] = self.segments
+        manifest_path = os.path.join(self.take_dir, "manifest.json")
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=4)
+        if self.source_dir != self.take_dir:
+            shutil.rmtree(self.source_dir, ignore_errors=True)
+        self.logger.log(f"Wrote manifest for {len(self.segments)} segments to {manifest_path}")
+        return manifest_path
+
+class IncrementalCopier:
+    """
+    Copies a recording to the USB drive while ffmpeg is still writing it, in large chunks
+    with copy_file_range/sendfile so the data never passes through python. At stop only
+    the tail is left to copy. Muxers go back and patch some bytes when they close a file
+    (headers at the start, and for AVI the size of every RIFF chunk), so those regions
+    are copied again in finish(), and the last lag_bytes are held back while recording
+    because mkv patches each cluster's size when it closes
+    """
+    def __init__(self, from_path, to_path, on_progress=None, chunk_size=8 * 1024 * 1024, lag_bytes=16 * 1024 * 1024, head_bytes=1024 * 1024, poll_interval=0.5, camera_metrics=None):
+        self.logger = Logger('IncrementalCopier')
+        self.camera_metrics = camera_metrics
+        self.from_path = from_path
+        self.to_path = to_path
+        self.on_progress = on_progress
+        self.chunk_size = chunk_size
+        self.lag_bytes = lag_bytes
+        self.head_bytes = head_bytes
+        self.poll_interval = poll_interval
+        self.copied_bytes = 0
+        self.total_bytes = 0
+        self._copy_mode = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+        self._src_fd = None
+        self._dst_fd = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _open(self):
+        if self._src_fd is None:
+            if not os.path.exists(self.from_path):
+                return False # ffmpeg has not created it yet
+            self._src_fd = os.open(self.from_path, os.O_RDONLY)
+            self._dst_fd = os.open(self.to_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        return True
+
+    def _copy_range(self, offset, count):
+        start = time.perf_counter()
+        copied = self._copy_range_once(offset, count)
+        if self.camera_metrics and copied > 0:
+            self.camera_metrics.usb_copied_bytes.inc(copied)
+            self.camera_metrics.usb_copy_seconds.inc(time.perf_counter() - start)
+        return copied
+
+    def _copy_range_once(self, offset, count):
+        # returns how many bytes were copied, tries the zero copy calls first
+        if self._copy_mode == "copy_file_range":
+            try:
+                return os.copy_file_range(self._src_fd, self._dst_fd, count, offset, offset)
+            except OSError:
+                # not supported between these filesystems (tmpfs -> vfat on most kernels)
+                self._copy_mode = "sendfile"
+        if self._copy_mode == "sendfile":
+            try:
+                os.lseek(self._dst_fd, offset, os.SEEK_SET)
+                return os.sendfile(self._dst_fd, self._src_fd, offset, count)
+            except OSError:
+                self._copy_mode = "read"
+        data = os.pread(self._src_fd, count, offset)
+        return os.pwrite(self._dst_fd, data, offset)
+
+    def _copy_until(self, end):
+        while self.copied_bytes < end:
+            copied = self._copy_range(self.copied_bytes, min(self.chunk_size, end - self.copied_bytes))
+            if copied <= 0:
+                break
+            self.copied_bytes += copied
+            if self.on_progress:
+                self.on_progress(self.copied_bytes, max(self.total_bytes, self.copied_bytes))
+
+    def _run(self):
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                if not self._open():
+                    continue
+                self._copy_until(os.fstat(self._src_fd).st_size - self.lag_bytes)
+            except OSError as e:
+                # not fatal, finish() starts over from where we got to
+                self.logger.error(f"Background copy to {self.to_path} failed: {e}")
+                return
+
+    def _rewritten_regions(self):
+        regions = [(0, self.head_bytes)]
+        with open(self.from_path, "rb") as f:
+            if f.read(4) != b"RIFF":
+                return regions
+            # walk the top level RIFF/AVIX chunks, their headers get patched on close
+            offset = 0
+            while offset < self.total_bytes:
+                f.seek(offset)
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                regions.append((offset, 4096))
+                offset += 8 + int.from_bytes(header[4:8], "little")
+        return regions
+
+    def finish(self):
+        # call after ffmpeg exited, returns once to_path is a complete copy
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if not self._open():
+            raise FileNotFoundError(self.from_path)
+        self.total_bytes = os.fstat(self._src_fd).st_size
+        self._copy_until(self.total_bytes)
+        for offset, count in self._rewritten_regions():
+            count = min(count, self.total_bytes - offset)
+            done = 0
+            while done < count:
+                copied = self._copy_range(offset + done, count - done)
+                if copied <= 0:
+                    break
+                done += copied
+        os.ftruncate(self._dst_fd, self.total_bytes)
+        os.fsync(self._dst_fd)
+        os.close(self._src_fd)
+        os.close(self._dst_fd)
+        os.remove(self.from_path)
+        if self.on_progress:
+            self.on_progress(self.total_bytes, self.total_bytes)
+        self.logger.log(f"Copied {self.total_bytes} bytes to {self.to_path} ({self._copy_mode})")
+
+class Job:
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.status = "queued" # queued, running, done, failed
+        self.total_bytes = 0
+        self.moved_bytes = 0
+        self.result = None
+        self.error = None
+        self.created_time = datetime.datetime.now().isoformat()
+        self.finished_time = None
+
+    def progress(self, moved_bytes, total_bytes):
+        self.moved_bytes = moved_bytes
+        self.total_bytes = total_bytes
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "total_bytes": self.total_bytes,
+            "moved_bytes": self.moved_bytes,
+            "result": self.result,
+            "error": self.error,
+            "created_time": self.created_time,
+            "finished_time": self.finished_time,
+        }
+
+class JobQueue:
+    """
+    Runs slow work like finishing a recording and moving it to USB on a worker thread,
+    one job at a time in the order they were submitted so back to back takes never
+    fight over the drive. Finished jobs are kept around (up to keep) for /jobs/{id}
+    """
+    def __init__(self, keep=100, on_change=None):
+        self.logger = Logger('JobQueue')
+        self.keep = keep
+        self.on_change = on_change
+        self.jobs = {}
+        self.current = None
+        # jobs are added from the event loop while the worker reads them
+        self._jobs_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, kind, fn):
+        # fn(job) does the work, can call job.progress() and returns the job result
+        job = self._add(Job(kind))
+        self._queue.put((job, fn))
+        self._changed()
+        return job
+
+    def _changed(self):
+        if not self.on_change:
+            return
+        try:
+            self.on_change()
+        except Exception as e:
+            # a broken callback must not take the worker thread down with it
+            self.logger.error(f"Job change callback failed: {e}")
+
+    def register(self, kind):
+        # a job that runs somewhere else (like the encode pool) but is still looked up by id
+        return self._add(Job(kind))
+
+    def _add(self, job):
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.status in ("queued", "running"):
+                    break
+                del self.jobs[oldest.id]
+        return job
+
+    def get(self, job_id):
+        with self._jobs_lock:
+            return self.jobs.get(job_id)
+
+    def pending(self, kind=None):
+        with self._jobs_lock:
+            jobs = list(self.jobs.values())
+        return [job for job in jobs if job.status in ("queued", "running") and (kind is None or job.kind == kind)]
+
+    def _run(self):
+        while True:
+            job, fn = self._queue.get()
+            self.current = job
+            job.status = "running"
+            self._changed()
+            try:
+                job.result = fn(job)
+                job.status = "done"
+            except Exception as e:
+                self.logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            job.finished_time = datetime.datetime.now().isoformat()
+            self.current = None
+            self._changed()
+
+TS_PACKET_SIZE = 188
+
+class PrerollSink:
+    """
+    Writes the pre-roll stream into a recording's remux ffmpeg from its own thread, like
+    RawFrameWriter does for raw frames, so a slow or dead ffmpeg never blocks the pre-roll
+    reader. The queue is not bounded, it holds encoded video and only grows while ffmpeg stalls
+    """
+    def __init__(self, proc: subprocess.Popen):
+        self.logger = Logger('PrerollSink')
+        self.proc = proc
+        self.dropped_frames = 0 # nothing is dropped, here for _stop_ffmpeg
+        self.failed = False
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, backlog):
+        # the backlog is written by the caller so a remux that died right away is an error there
+        for data in backlog:
+            self.proc.stdin.write(data)
+        self._thread.start()
+
+    def put(self, data):
+        if not self.failed:
+            self._queue.put(data)
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            try:
+                self.proc.stdin.write(data)
+            except (BrokenPipeError, ValueError, OSError) as e:
+                self.logger.error(f"Recording stopped accepting pre-roll stream: {e}")
+                self.failed = True
+                break
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+    def close(self, timeout=10):
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+class PrerollBuffer:
+    """
+    Keeps the last few seconds of encoded video in memory so a take can include what
+    happened before Record was pressed. A long running ffmpeg encodes the camera to
+    MPEG-TS on stdout and the stream is cut into GOPs at every keyframe (random access
+    indicator). Only whole GOPs are kept, bounded by seconds and bytes. When a recording
+    attaches it first gets the stream headers and the buffered GOPs, then the live stream
+    """
+    def __init__(self, command, profile, uses_stdin, frame_shape, seconds, max_bytes, dropped_counter=None):
+        self.logger = Logger('PrerollBuffer')
+        self.dropped_counter = dropped_counter
+        self.command = command
+        self.profile = profile # encoder profile of what is buffered, takes are copies of it
+        self.uses_stdin = uses_stdin
+        self.frame_shape = frame_shape
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.writer = None
+        self.bytes = 0
+        self._gops = deque() # (start monotonic time, bytes)
+        self._current_gop = bytearray()
+        self._current_start = None
+        self._pat = None
+        self._pmt = None
+        self._pmt_pid = None
+        self._sink = None
+        self._proc = None
+        self._pending = None # (command, profile) to restart with
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def restart(self, command, profile):
+        # new encoder settings, the buffer starts over since old GOPs do not match them
+        self._pending = (command, profile)
+        proc = self._proc
+        if proc is not None:
+            proc.terminate()
+
+    @property
+    def buffered_seconds(self):
+        with self._lock:
+            if self._current_start is None:
+                return 0
+            oldest = self._gops[0][0] if self._gops else self._current_start
+            return time.monotonic() - oldest
+
+    def attach(self, proc):
+        """
+        Returns a PrerollSink feeding proc's stdin everything buffered and the live stream
+        after that. Only the snapshot is taken under the lock, the buffered GOPs are written
+        outside it so the reader thread keeps going. Raises if proc stops accepting them
+        """
+        sink = PrerollSink(proc)
+        with self._lock:
+            backlog = [packet for packet in (self._pat, self._pmt) if packet is not None]
+            backlog += [gop for _, gop in self._gops]
+            backlog.append(bytes(self._current_gop))
+            # live data queues up in the sink until the backlog is written
+            self._sink = sink
+        try:
+            sink.start(backlog)
+        except (BrokenPipeError, ValueError, OSError):
+            self.detach()
+            raise
+        return sink
+
+    def detach(self):
+        with self._lock:
+            self._sink = None
+
+    def _run(self):
+        while True:
+            proc = subprocess.Popen(self.command, stdin=subprocess.PIPE if self.uses_stdin else None,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self._proc = proc
+            self.writer = RawFrameWriter(proc, self.frame_shape, dropped_counter=self.dropped_counter) if self.uses_stdin else None
+            self.logger.log(f"Pre-roll encoder started with profile {self.profile}, keeping {self.seconds}s")
+            fd = proc.stdout.fileno()
+            remainder = b""
+            while True:
+                data = os.read(fd, TS_PACKET_SIZE * 512)
+                if not data or self._pending:
+                    break
+                data = remainder + data
+                usable = len(data) - len(data) % TS_PACKET_SIZE
+                remainder = data[usable:]
+                self._handle(data[:usable])
+            writer = self.writer
+            self.writer = None
+            if writer:
+                writer.close(timeout=1)
+            if self._pending:
+                proc.terminate()
+                proc.wait()
+                self._apply_pending()
+                continue
+            proc.wait()
+            self.logger.error(f"Pre-roll encoder exited ({proc.returncode}), restarting")
+            time.sleep(1)
+
+    def _apply_pending(self):
+        with self._lock:
+            self.command, self.profile = self._pending
+            self._pending = None
+            self._gops.clear()
+            self._current_gop = bytearray()
+            self._current_start = None
+            self._pat = None
+            self._pmt = None
+            self._pmt_pid = None
+            self.bytes = 0
+
+    def _handle(self, data):
+        with self._lock:
+            start = 0
+            for offset in range(0, len(data), TS_PACKET_SIZE):
+                if data[offset] != 0x47:
+                    continue # out of sync, ffmpeg never does this but do not crash on it
+                pid = ((data[offset + 1] & 0x1F) << 8) | data[offset + 2]
+                if pid == 0:
+                    self._pat = data[offset:offset + TS_PACKET_SIZE]
+                    self._parse_pat(self._pat)
+                elif pid == self._pmt_pid:
+                    self._pmt = data[offset:offset + TS_PACKET_SIZE]
+                elif (data[offset + 3] & 0x20) and data[offset + 4] > 0 and (data[offset + 5] & 0x40):
+                    # adaptation field with random_access_indicator set, a keyframe starts here
+                    self._append(data[start:offset])
+                    self._close_gop()
+                    start = offset
+            self._append(data[start:])
+
+    def _parse_pat(self, packet):
+        # first program in the PAT points at the PMT, that is all ffmpeg writes
+        payload = 4
+        if packet[3] & 0x20:
+            payload += 1 + packet[4]
+        if not packet[1] & 0x40:
+            return
+        section = payload + 1 + packet[payload]
+        first_program = section + 8
+        if first_program + 4 <= len(packet):
+            self._pmt_pid = ((packet[first_program + 2] & 0x1F) << 8) | packet[first_program + 3]
+
+    def _append(self, data):
+        if not data:
+            return
+        if self._sink is not None:
+            self._sink.put(data)
+        if self._current_start is None:
+            return # wait for the first keyframe, nothing before it is decodable
+        self._current_gop += data
+        self.bytes += len(data)
+
+    def _close_gop(self):
+        now = time.monotonic()
+        if self._current_start is not None:
+            self._gops.append((self._current_start, bytes(self._current_gop)))
+        self._current_gop = bytearray()
+        self._current_start = now
+        # drop a gop only when the ones after it still cover the whole pre-roll
+        while len(self._gops) > 1 and now - self._gops[1][0] >= self.seconds:
+            self.bytes -= len(self._gops.popleft()[1])
+        while self._gops and self.bytes > self.max_bytes:
+            self.bytes -= len(self._gops.popleft()[1])
+
+def iter_mp4_boxes(data, offset=0, end=None):
+    # yields (type, start, end) of every box in data[offset:end], start is where the header begins
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size = int.from_bytes(data[offset:offset + 4], "big")
+        box_type = bytes(data[offset + 4:offset + 8])
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[offset + 8:offset + 16], "big")
+            header = 16
+        if size < header:
+            return
+        yield box_type, offset, offset + size, header
+        offset += size
+
+def fragment_starts_with_keyframe(moof):
+    """
+    Looks at the first sample of a moof (tfhd defaults, trun first_sample_flags or the
+    per sample flags) and tells if it is a sync sample, so new viewers can start there
+    """
+    for box_type, start, end, header in iter_mp4_boxes(moof):
+        if box_type != b"moof":
+            continue
+        for traf_type, traf_start, traf_end, traf_header in iter_mp4_boxes(moof, start + header, end):
+            if traf_type != b"traf":
+                continue
+            default_flags = None
+            for child_type, child_start, child_end, child_header in iter_mp4_boxes(moof, traf_start + traf_header, traf_end):
+                body = child_start + child_header
+                flags = int.from_bytes(moof[body + 1:body + 4], "big")
+                if child_type == b"tfhd":
+                    pos = body + 8 # version/flags, track_ID
+                    pos += 8 if flags & 0x01 else 0 # base_data_offset
+                    pos += 4 if flags & 0x02 else 0 # sample_description_index
+                    pos += 4 if flags & 0x08 else 0 # default_sample_duration
+                    pos += 4 if flags & 0x10 else 0 # default_sample_size
+                    if flags & 0x20:
+                        default_flags = int.from_bytes(moof[pos:pos + 4], "big")
+                elif child_type == b"trun":
+                    pos = body + 8 # version/flags, sample_count
+                    pos += 4 if flags & 0x01 else 0 # data_offset
+                    if flags & 0x04:
+                        sample_flags = int.from_bytes(moof[pos:pos + 4], "big")
+                    elif flags & 0x400:
+                        pos += 4 if flags & 0x100 else 0
+                        pos += 4 if flags & 0x200 else 0
+                        sample_flags = int.from_bytes(moof[pos:pos + 4], "big")
+                    else:
+                        sample_flags = default_flags
+                    if sample_flags is None:
+                        return False
+                    # sample_is_non_sync_sample
+                    return not sample_flags & 0x00010000
+    return False
+
+class H264PreviewClient(asyncio.Queue):
+    def __init__(self, maxsize):
+        super().__init__(maxsize=maxsize)
+        self.id = uuid.uuid4().hex[:8]
+        self.waiting_for_keyframe = False
+
+class H264PreviewStream:
+    """
+    Low bandwidth preview: a scaled down h264 sub-stream from the same encoder used for
+    recording, muxed as fragmented MP4 and sent over a WebSocket for MSE playback.
+    ffmpeg only runs while someone is watching. New viewers get the init segment and the
+    fragments since the last keyframe, a viewer that falls behind skips ahead to the
+    next keyframe fragment since fragments can not simply be dropped like JPEGs
+    """
+    def __init__(self, command, uses_stdin, frame_shape, queue_size=30, camera_metrics=None):
+        self.logger = Logger('H264PreviewStream')
+        self.camera_metrics = camera_metrics
+        self.command = command
+        self.uses_stdin = uses_stdin
+        self.frame_shape = frame_shape
+        self.queue_size = queue_size
+        self.writer = None
+        self.init_segment = None
+        self.codec = None
+        self._gop = []
+        self._clients = set()
+        self._loop = None
+        self._proc = None
+
+    def subscribe(self):
+        client = H264PreviewClient(self.queue_size)
+        if self.init_segment is not None:
+            client.put_nowait(self.init_segment)
+            for fragment in self._gop[-self.queue_size + 1:]:
+                client.put_nowait(fragment)
+        else:
+            client.waiting_for_keyframe = True
+        if self._proc is None:
+            # raises if ffmpeg cannot be started, the client was never added
+            self._loop = asyncio.get_running_loop()
+            self._start()
+        self._clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        self._clients.discard(client)
+        if not self._clients and self._proc is not None:
+            self._stop()
+
+    def _start(self):
+        self._proc = subprocess.Popen(self.command, stdin=subprocess.PIPE if self.uses_stdin else None,
+                                      stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.writer = RawFrameWriter(self._proc, self.frame_shape, dropped_counter=self.camera_metrics.h264_preview_dropped_frames if self.camera_metrics else None) if self.uses_stdin else None
+        threading.Thread(target=self._read, args=(self._proc,), daemon=True).start()
+        self.logger.log("Started h264 preview encoder")
+
+    def _stop(self):
+        proc = self._proc
+        writer = self.writer
+        self._proc = None
+        self.writer = None
+        self.init_segment = None
+        self._gop = []
+        if writer:
+            threading.Thread(target=writer.close, daemon=True).start() # ffmpeg exits on EOF
+        else:
+            proc.terminate()
+        self.logger.log("No more h264 preview clients, stopping encoder")
+
+    def _read(self, proc):
+        buffer = bytearray()
+        init = bytearray()
+        moof = None
+        fd = proc.stdout.fileno()
+        while True:
+            data = os.read(fd, 256 * 1024)
+            if not data:
+                break
+            buffer += data
+            consumed = 0
+            for box_type, start, end, header in iter_mp4_boxes(buffer):
+                if end > len(buffer):
+                    break # box not complete yet
+                consumed = end
+                box = bytes(buffer[start:end])
+                if box_type in (b"ftyp", b"moov"):
+                    init += box
+                    if box_type == b"moov":
+                        self._loop.call_soon_threadsafe(self._set_init, proc, bytes(init))
+                elif box_type == b"moof":
+                    moof = box
+                elif box_type == b"mdat" and moof is not None:
+                    self._loop.call_soon_threadsafe(self._publish, proc, moof + box, fragment_starts_with_keyframe(moof))
+                    moof = None
+            del buffer[:consumed]
+        proc.wait()
+        self._loop.call_soon_threadsafe(self._exited, proc)
+
+    def _exited(self, proc):
+        if proc is not self._proc:
+            return # stopped on purpose
+        self.logger.error(f"h264 preview encoder exited ({proc.returncode}), disconnecting its viewers")
+        writer = self.writer
+        self._proc = None
+        self.writer = None
+        self.init_segment = None
+        self._gop = []
+        if writer:
+            threading.Thread(target=writer.close, daemon=True).start()
+        # None tells each viewer the stream is over, the next subscribe starts a new encoder
+        for client in self._clients:
+            while not client.empty():
+                client.get_nowait()
+            client.put_nowait(None)
+        self._clients.clear()
+
+    def _set_init(self, proc, init):
+        if proc is not self._proc:
+            return
+        self.init_segment = init
+        # avcC holds profile, compatibility and level, which is what MSE wants in the codec string
+        avcc = init.find(b"avcC")
+        if avcc != -1:
+            self.codec = "avc1.%02X%02X%02X" % (init[avcc + 5], init[avcc + 6], init[avcc + 7])
+        for client in self._clients:
+            if client.empty():
+                client.put_nowait(init)
+
+    def _publish(self, proc, fragment, keyframe):
+        if proc is not self._proc:
+            return # a fragment from an encoder we already stopped
+        if keyframe:
+            self._gop = []
+        self._gop.append(fragment)
+        for client in self._clients:
+            if keyframe:
+                client.waiting_for_keyframe = False
+            if client.waiting_for_keyframe:
+                continue
+            if client.full():
+                # too slow, throw away what is queued and resume at the next keyframe
+                if self.camera_metrics:
+                    self.camera_metrics.h264_dropped_fragments.inc(client.qsize())
+                while not client.empty():
+                    client.get_nowait()
+                client.waiting_for_keyframe = True
+                continue
+            client.put_nowait(fragment)
+
+class EncodePool:
+    """
+    Small fixed size thread pool for image encoding. OpenCV releases the GIL while it
+    resizes and encodes, so this runs in parallel with the event loop instead of
+    blocking every other request. pending is how many jobs are queued or running
+    """
+    def __init__(self, workers, name="encode"):
+        self.workers = workers
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self.pending += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+def encode_jpeg(frame: np.ndarray, scale, encode_params, encode_seconds=None):
+    # resize + encode in one go so both happen on the encode pool
+    start = time.perf_counter()
+    if scale != 1:
+        frame = cv2.resize(frame, (int(frame.shape[1] * scale), int(frame.shape[0] * scale)))
+    ret, buffer = cv2.imencode('.jpg', frame, encode_params)
+    if encode_seconds is not None:
+        encode_seconds.observe(time.perf_counter() - start)
+    return buffer.tobytes() if ret else None
+
+class BurstCapture:
+    """
+    Collects count consecutive camera frames into one preallocated array. It is fed from
+    the capture thread itself so no frame can be skipped, which costs one memcpy per
+    frame there. Encoding happens afterwards on the encode pool. A burst that does not
+    fill up before its deadline (the camera stopped sending frames) is closed with what
+    it has
+    """
+    def __init__(self, count, shape, jobs, timeout):
+        self.frames = np.zeros((count, *shape), dtype=np.uint8)
+        self.jobs = jobs
+        self.captured = 0
+        self.closed = False
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def add(self, frame: np.ndarray):
+        # returns True once the burst is full, closing it
+        with self._lock:
+            if self.closed:
+                return False
+            slot = self.frames[self.captured]
+            if frame.shape == slot.shape:
+                np.copyto(slot, frame)
+            elif frame.ndim == 3 and frame.shape[2] == 3:
+                # the camera came back at another size, keep the burst consecutive anyway
+                cv2.resize(frame, (slot.shape[1], slot.shape[0]), dst=slot)
+            else:
+                return False
+            self.jobs[self.captured].status = "running"
+            self.captured += 1
+            self.closed = self.captured == len(self.frames)
+            return self.closed
+
+    def close(self):
+        # returns False if add() already closed it
+        with self._lock:
+            if self.closed:
+                return False
+            self.closed = True
+            return True
+
+DEFAULT_CAMERA_ID = "main"
+
+def configured_cameras():
+    """
+    [{"id", "device", "virtual_device"}] for every camera in the config. Without a cameras
+    list it is just camera_device on the configured virtual device, like before there
+    could be more than one
+    """
+    if not config["cameras"]:
+        return [{"id": DEFAULT_CAMERA_ID, "device": config["camera_device"], "virtual_device": config["virtual_device"]["device"]}]
+    cameras = []
+    for i, entry in enumerate(config["cameras"]):
+        cameras.append({
+            "id": str(entry.get("id", i)),
+            "device": entry["device"],
+            "virtual_device": entry.get("virtual_device", f"/dev/video{40 + i}"),
+        })
+    ids = [camera["id"] for camera in cameras]
+    if len(set(ids)) != len(ids):
+        LOGS.error(f"Camera ids must be unique, got {ids}. Edit in config located in {config_path}")
+        sys.exit(1)
+    return cameras
+
+def load_loopback_devices(cameras):
+    """
+    (Re)loads v4l2loopback once with a device per camera, loading it again for every camera
+    would tear down the devices of the ones before it. Returns False if it could not be loaded
+    """
+    if subprocess.call(["sudo", "modprobe", "-r", "v4l2loopback"]) != 0:
+        LOGS.error("Failed to unload v4l2loopback module")
+        return False
+    if len(cameras) == 1:
+        labels = [config["virtual_device"]["name"]]
+    else:
+        labels = [f"{config['virtual_device']['name']} {camera['id']}" for camera in cameras]
+    # create the virtual cameras modprobe, the module takes comma separated lists
+    result = subprocess.run([
+        "sudo", "modprobe", "v4l2loopback",
+        f"devices={len(cameras)}",
+        f"video_nr={','.join(camera['virtual_device'].removeprefix('/dev/video') for camera in cameras)}",
+        f"card_label={','.join(label.replace(',', ' ') for label in labels)}",
+        f"exclusive_caps={','.join('1' for _ in cameras)}",
+        "output=1"
+    ])
+    return result.returncode == 0
+
 class CameraInterface:
+    """
+    One capture device with its own capture thread, encoders, loopback device and
+    preview. media_index, thumbnails and available_encoders can be shared between
+    cameras (see CameraRegistry), they are created when not given
+    """
+    # devices opened by any camera, so one looking for its unplugged device never takes another's
+    devices_in_use = set()
+
     def init_folder_struct(self):
         usb_path = config["usb_path"]
         if config['usb_mode'] and not usb_path:
@@ -135,9 +1325,17 @@ class CameraInterface:
 
             return os.path.join(other_path, "picasso")
 
-    def __init__(self):
-        self.logger = Logger('CameraInterface')
+    def __init__(self, camera_id=DEFAULT_CAMERA_ID, device=None, virtual_device=None, media_index=None, thumbnails=None, available_encoders=None):
+        self.id = camera_id
+        self.device = device or config["camera_device"]
+        self.virtual_device = virtual_device or config["virtual_device"]["device"]
+        # files of other cameras taken in the same second would only differ by a _2
+        self.file_tag = "" if camera_id == DEFAULT_CAMERA_ID else f"__{camera_id}"
+        self.logger = Logger('CameraInterface' if camera_id == DEFAULT_CAMERA_ID else f'CameraInterface {camera_id}')
+        self.metrics = CameraMetrics(camera_id)
+        self.tracer = FrameTracer(camera_id, FRAME_LATENCY) if config["frame_tracing"] else None
         self.metadata = {
+            "camera_id": camera_id,
             "recording": False,
             "start_time": None,
             "end_time": None,
@@ -151,104 +1349,265 @@ class CameraInterface:
             "memory_usage": {
                 "total_bytes": 0,
                 "used_bytes": 0,
-                "free_bytes": 0
+                "free_bytes": 0,
+                "preroll_bytes": 0,
+                "preroll_seconds": 0
             },
             "saving": {
                 "complete": True,
                 "total_bytes": 0,
                 "moved_bytes": 0,
-            }
+                "job_id": None,
+                "queued": 0,
+            },
+            "encoder": None,
+            "capture_format": None,
+            "root": None,
+            "encode_queue": {
+                "workers": config["encode_workers"],
+                "pending": 0,
+            },
         }
+        self._metadata_lock = threading.Lock()
+        self._metadata_snapshot = None
+        self.metadata_notifier = FrameNotifier() # same seq/wake mechanism as frames, for /metadata/events
         self._failed_frame_count = 0
         self._temp_output_path = None
-        self._black_frame = np.zeros((int(config["resolution"].split("x")[1]), int(config["resolution"].split("x")[0]), 3), dtype=np.uint8)
+        # parsed once, the frame loops should never have to split the config string
+        self.width, self.height = (int(v) for v in config["resolution"].split("x"))
+        self._black_frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
         # add text in the center
-        cv2.putText(self._black_frame, f"'{config['camera_device']}' Error", (int(config["resolution"].split("x")[0]) // 4, int(config["resolution"].split("x")[1]) // 2), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 5, cv2.LINE_AA)
+        cv2.putText(self._black_frame, f"'{self.device}' Error", (self.width // 4, self.height // 2), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 5, cv2.LINE_AA)
+        self._resize_buffer = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self.capture_format = None
         self._frame_buffer = []
         self._cur_frame = None
+        self.frame_notifier = FrameNotifier()
+        self.frame_ring = FrameRing(self._black_frame.shape)
         self._ffmpeg_pid = None
         self.root = self.init_folder_struct()
+        self.metadata['root'] = self.root.rsplit('/', 1)[0]
+        self.media_index = media_index or MediaIndex(self.root)
+        self.thumbnails = thumbnails or ThumbnailCache(self.root)
 
-        if subprocess.call(["sudo", "modprobe", "-r", "v4l2loopback"]) != 0:
-            self.logger.error("Failed to unload v4l2loopback module")
+        self._raw_writer = None
+        self._preroll_sink = None
+        self._ffmpeg_proc = None
+        self._segment_mover = None
+        self._copier = None
+        self._take_path = None
+        self._preroll = None
+        self.jobs = JobQueue(on_change=self._update_saving)
+        self.encode_pool = EncodePool(config["encode_workers"])
+        # a burst queues up dozens of saves, the preview must not wait behind them
+        self.preview_pool = EncodePool(len(config["preview_ladder"]), name="preview_encode")
+        self._burst = None
+        if config["container"] not in CONTAINER_ARGS:
+            self.logger.error(f"Unknown container: {config['container']}, must be \"mkv\" or \"mp4\"")
+            sys.exit(1)
+        if config["recording_backend"] not in ("loopback", "pipe"):
+            self.logger.error(f"Unknown recording_backend: {config['recording_backend']}, must be \"loopback\" or \"pipe\"")
+            sys.exit(1)
+        if config["virtual_camera_backend"] not in ("v4l2loopback", "null"):
+            self.logger.error(f"Unknown virtual_camera_backend: {config['virtual_camera_backend']}, must be \"v4l2loopback\" or \"null\"")
+            sys.exit(1)
+        if config["recording_backend"] == "loopback" and (not config["virtual_camera"] or config["virtual_camera_backend"] == "null"):
+            self.logger.error(f"recording_backend \"loopback\" needs virtual_camera enabled with virtual_camera_backend \"v4l2loopback\". Edit in config located in {config_path}")
             sys.exit(1)
 
-        # create the virtual camera modprobe
-        subprocess.run(["sudo", "modprobe", "v4l2loopback", "devices=1", "video_nr=40", f"card_label={config['virtual_device']['name']}", "exclusive_caps=1", "output=1"])
-        # verify we can access the virtual camera device
-        if subprocess.run(["v4l2-ctl", "--device", config["virtual_device"]["device"], "--all"], capture_output=True).returncode != 0:
-            self.logger.error(f"Cannot access virtual camera device {config['virtual_device']['device']}")
+        self.virtual_camera_enabled = config["virtual_camera"] and self.init_virtual_camera()
+
+        self.available_encoders = available_encoders if available_encoders is not None else probe_encoders()
+        self.encoder = select_encoder(self.available_encoders)
+        if config["encoder_profile"] not in config["encoder_profiles"]:
+            self.logger.error(f"Unknown encoder_profile: {config['encoder_profile']}. Edit in config located in {config_path}")
             sys.exit(1)
+        self.metadata["encoder"] = {
+            "name": self.encoder,
+            "profile": config["encoder_profile"],
+        }
+        self.logger.log(f"Using encoder {self.encoder} with profile {config['encoder_profile']}")
+
+        if config["preroll_seconds"] > 0:
+            self._preroll = PrerollBuffer(self._preroll_command(config["encoder_profile"]), config["encoder_profile"],
+                config["recording_backend"] == "pipe", (self.height, self.width, 3), config["preroll_seconds"], config["preroll_max_bytes"],
+                dropped_counter=self.metrics.preroll_dropped_frames)
+
+        preview_scale = f"scale=trunc(iw*{config['h264_preview_scale']}/2)*2:trunc(ih*{config['h264_preview_scale']}/2)*2"
+        preview_args = encoder_args(self.encoder, {"bitrate": config["h264_preview_bitrate"], "preset": "ultrafast", "gop": config["fps"], "crf": None})
+        if self.encoder == "libx264":
+            preview_args += ["-tune", "zerolatency"]
+        self.h264_preview = H264PreviewStream([
+            "ffmpeg",
+            *self._input_args(),
+            "-vf", preview_scale,
+            *preview_args,
+            "-bf", "0",
+            "-f", "mp4",
+            # short fragments for latency, empty moov so the init segment comes first
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-frag_duration", "100000",
+            "-"
+        ], config["recording_backend"] == "pipe", (self.height, self.width, 3), camera_metrics=self.metrics)
+
+        self.preview_broadcaster = PreviewBroadcaster(self, config["preview_ladder"])
+        # read when /metrics is scraped, nothing to keep up to date
+        self.metrics.mjpeg_clients.set_function(lambda: len(self.preview_broadcaster._subscribers))
+        self.metrics.h264_clients.set_function(lambda: len(self.h264_preview._clients))
+        self.metrics.encode_pool_pending.set_function(lambda: self.encode_pool.pending)
+        self.metrics.capture_consecutive_failed_reads.set_function(
+            lambda: self._capture.ring.get_header(FAILED_READS) if self._capture else self._failed_frame_count)
+
+        self._capture = None
+        self.cap = None
+        CameraInterface.devices_in_use.add(self.device)
+        if config["capture_process"]:
+            # opened by the capture process once start() spawns it
+            self._capture = CaptureProcess(self.id, self.device, self._black_frame.shape, config["fps"])
+            if not self._capture.owner:
+                self.logger.log(f"Another process is capturing {self.device}, attaching to its frames")
+            self.publish_metadata()
+            return
 
-        self.logger.log("Successfully created virtual camera")
         try:
-            self.cap = cv2.VideoCapture(config["camera_device"]) 
+            self.cap = open_source(self.device)
         except Exception as e:
             self.logger.error(f"Failed to create video capture: {e}")
             self.wait_for_camera()
 
         try:
-            # set fps and resolution
-            self.cap.set(cv2.CAP_PROP_FPS, config["fps"])
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, int(config["resolution"].split("x")[0]))
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, int(config["resolution"].split("x")[1]))
+            self.configure_capture()
         except Exception as e:
             self.logger.error(f"Failed to set video capture properties: {e}")
             sys.exit(1)
+        self.publish_metadata()
+
+    def init_virtual_camera(self):
+        # the pipe backend does not need the loopback device, so only give up if recording depends on it
+        required = config["recording_backend"] == "loopback"
+        if config["virtual_camera_backend"] == "null":
+            self.logger.log("Using the null virtual camera, frames are converted but not sent anywhere")
+            return True
+        # verify we can access the virtual camera device, CameraRegistry loaded the module
+        if subprocess.run(["v4l2-ctl", "--device", self.virtual_device, "--all"], capture_output=True).returncode != 0:
+            self.logger.error(f"Cannot access virtual camera device {self.virtual_device}")
+            if required:
+                sys.exit(1)
+            self.logger.warn("Continuing without virtual camera")
+            return False
+
+        self.logger.log(f"Successfully created virtual camera {self.virtual_device}")
+        return True
+
+    def configure_capture(self):
+        # set fps and resolution
+        self.cap.set(cv2.CAP_PROP_FPS, config["fps"])
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        # the driver is free to pick something else, check what we actually got once
+        # here so on_frame knows if it has to resize at all
+        fourcc = int(self.cap.get(cv2.CAP_PROP_FOURCC))
+        self.capture_format = {
+            "width": int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "fps": self.cap.get(cv2.CAP_PROP_FPS),
+            "fourcc": "".join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip("\x00"),
+        }
+        self.metadata["capture_format"] = self.capture_format
+        if (self.capture_format["width"], self.capture_format["height"]) != (self.width, self.height):
+            self.logger.warn(f"Camera delivers {self.capture_format['width']}x{self.capture_format['height']} instead of {config['resolution']}, frames will be resized")
+        else:
+            self.logger.log(f"Camera format: {config['resolution']} {self.capture_format['fourcc']} @ {self.capture_format['fps']} fps")
 
     def wait_for_camera(self, delay=2):
         # this is in the event the camera gets unplugged, we wait for it to come back
-        self.logger.log(f"Waiting for camera {config['camera_device']} to become available...")
+        self.logger.log(f"Waiting for camera {self.device} to become available...")
         # for some reason linux likes to change the device number when unplugging and replugging
-        # scan if opening config["camera_device"] does not work, start to 0 and dont use 40 its reserved for the virtual cam
+        # scan if opening self.device does not work, start to 0 and dont use 40 its reserved for the virtual cam
         while True:
-            if os.path.exists(config["camera_device"]):
+            # synthetic and file sources have nothing to rescan, they only get reopened
+            if os.path.exists(self.device) or not is_capture_device(self.device):
                 try:
-                    test_cap = cv2.VideoCapture(config["camera_device"])
+                    test_cap = open_source(self.device)
                     if test_cap.isOpened():
                         test_cap.release()
-                        self.logger.log(f"Camera {config['camera_device']} is now available")
-                        self.cap = cv2.VideoCapture(config["camera_device"])
-                        # set fps and resolution
-                        self.cap.set(cv2.CAP_PROP_FPS, config["fps"])
-                        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, int(config["resolution"].split("x")[0]))
-                        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, int(config["resolution"].split("x")[1]))
+                        self.logger.log(f"Camera {self.device} is now available")
+                        self.cap = open_source(self.device)
+                        self.configure_capture()
                         return
                 except Exception as e:
-                    self.logger.error(f"Error accessing camera {config['camera_device']}: {e}")
+                    self.logger.error(f"Error accessing camera {self.device}: {e}")
             else:
                 # iterate through possible video devices
                 for i in range(0, 10):
                     device_path = f"/dev/video{i}"
+                    if device_path in CameraInterface.devices_in_use:
+                        continue # another camera's
                     if os.path.exists(device_path):
                         try:
                             test_cap = cv2.VideoCapture(device_path)
                             if test_cap.isOpened():
                                 test_cap.release()
                                 self.logger.log(f"Camera found at {device_path}, updating config")
-                                config["camera_device"] = device_path
-                                self.cap = cv2.VideoCapture(config["camera_device"])
-                                # set fps and resolution
-                                self.cap.set(cv2.CAP_PROP_FPS, config["fps"])
-                                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, int(config["resolution"].split("x")[0]))
-                                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, int(config["resolution"].split("x")[1]))
+                                CameraInterface.devices_in_use.discard(self.device)
+                                CameraInterface.devices_in_use.add(device_path)
+                                self.device = device_path
+                                if self.id == DEFAULT_CAMERA_ID:
+                                    config["camera_device"] = device_path
+                                self.cap = cv2.VideoCapture(self.device)
+                                self.configure_capture()
                                 return
                         except Exception as e:
                             self.logger.error(f"Error accessing camera {device_path}: {e}")
             time.sleep(delay)
 
     def start(self):
-        asyncio.run(self.recv_frame())
+        # capture only grabs frames, everything else consumes them on its own thread
+        if self._capture:
+            self._capture.start()
+            threading.Thread(target=self.recv_shared_frames, daemon=True).start()
+        else:
+            threading.Thread(target=self.recv_frame, daemon=True).start()
+        threading.Thread(target=self.run_output_writer, daemon=True).start()
+        if self._preroll:
+            self._preroll.start()
+        threading.Thread(target=self.run_metadata_sampler, daemon=True).start()
+
+    def add_to_library(self, path, kind):
+        self.media_index.add(path, kind)
+        # ready before anyone opens the library
+        self.thumbnails.schedule(path, kind)
+        if kind == "video":
+            threading.Thread(target=prepare_playback, args=(path,), daemon=True).start()
 
     def makeIfNotDir(self, dir_path):
         if not os.path.exists(dir_path):
             os.makedirs(dir_path, exist_ok=True)
 
     def get_metadata(self):
+        # cached, see publish_metadata and run_metadata_sampler
+        return self._metadata_snapshot
+
+    def publish_metadata(self):
+        """
+        Takes an immutable snapshot of self.metadata for /metadata and wakes up the
+        /metadata/events streams if anything changed. Call after changing self.metadata
+        """
+        with self._metadata_lock:
+            snapshot = copy.deepcopy(self.metadata)
+            if snapshot == self._metadata_snapshot:
+                return
+            self._metadata_snapshot = snapshot
+        self.metadata_notifier.publish()
+
+    def sample_system_stats(self):
         mem = psutil.virtual_memory()
         self.metadata["memory_usage"]["total_bytes"] = mem.total
         self.metadata["memory_usage"]["used_bytes"] = mem.used
         self.metadata["memory_usage"]["free_bytes"] = mem.available
+        self.metadata["memory_usage"]["preroll_bytes"] = self._preroll.bytes if self._preroll else 0
+        self.metadata["memory_usage"]["preroll_seconds"] = self._preroll.buffered_seconds if self._preroll else 0
+        self.metadata["encode_queue"]["pending"] = self.encode_pool.pending
         if config["usb_mode"]:
             path = config["usb_path"]
         else:
@@ -262,9 +1621,24 @@ class CameraInterface:
             self.metadata["storage_usage"]["total_bytes"] = 0
             self.metadata["storage_usage"]["used_bytes"] = 0
             self.metadata["storage_usage"]["free_bytes"] = 0
-        root = self.root
-        self.metadata['root'] = root.rsplit('/', 1)[0]
-        return self.metadata
+
+    def sample_metrics(self):
+        if self._capture:
+            # counted by the capture process, it keeps them in the ring header
+            self.metrics.capture_failed_reads.value = self._capture.ring.get_header(FAILED_READS_TOTAL)
+            self.metrics.capture_reopens.value = self._capture.ring.get_header(CAMERA_REOPENS)
+        self.metrics.sample()
+
+    def run_metadata_sampler(self):
+        # psutil calls are slow-ish, keep them off the request path and on a fixed cadence
+        while True:
+            try:
+                self.sample_system_stats()
+            except Exception as e:
+                self.logger.error(f"Failed to sample system stats: {e}")
+            self.sample_metrics()
+            self.publish_metadata()
+            time.sleep(config["metadata_interval"])
     
 
     def _getTempPath(self):
@@ -275,30 +1649,71 @@ class CameraInterface:
         """
         if not os.path.exists("/tmp/picasso"):
             os.makedirs("/tmp/picasso", exist_ok=True)
-        rand_name = f"temp_{int(time.time())}.avi"
+        # unique even for two takes within the same second
+        rand_name = f"temp_{int(time.time())}_{uuid.uuid4().hex[:8]}.{config['container']}"
         return os.path.join("/tmp/picasso", rand_name)
     
 
     def getNextVideoPath(self):
         video_dir = os.path.join(self.root, "videos")
-        # picasso/videos/MonthFullNameYYYY/dayNumberHHMMSS.avi
+        # picasso/videos/MonthFullNameYYYY/dayNumberHHMMSS.mkv (or .mp4)
         now = time.localtime()
         month_full_name = time.strftime("%B", now)
         day_number = time.strftime("%d", now)
         time_str = time.strftime("%I_%M_%S_%p", now)
-        video_path = os.path.join(video_dir, f"{month_full_name}{now.tm_year}/{day_number}__{time_str}.avi")
+        base_path = os.path.join(video_dir, f"{month_full_name}{now.tm_year}/{day_number}__{time_str}{self.file_tag}")
+        extension = f".{config['container']}"
+        video_path = base_path + extension
+        # a take started in the same second must not overwrite the previous one (or its segment folder)
+        n = 2
+        while os.path.exists(video_path) or os.path.exists(os.path.splitext(video_path)[0]):
+            video_path = f"{base_path}_{n}{extension}"
+            n += 1
         if not os.path.exists(video_path):
             self.makeIfNotDir(os.path.dirname(video_path))
         return video_path
 
-    def getNextPicturePath(self):
+    def getNextTakeDir(self):
+        # segmented takes get a folder named like getNextVideoPath would name the file
+        take_dir = os.path.splitext(self.getNextVideoPath())[0]
+        self.makeIfNotDir(take_dir)
+        return take_dir
+
+    def _segment_output_args(self, segment_dir, list_path, encoding=True):
+        seconds = config["segment_seconds"]
+        args = []
+        if encoding:
+            # cut exactly on the segment boundaries instead of whenever the next gop starts
+            args += ["-force_key_frames", f"expr:gte(t,n_forced*{seconds})"]
+        args += [
+            "-f", "segment",
+            "-segment_time", str(seconds),
+            "-reset_timestamps", "1",
+            "-segment_list", list_path,
+            "-segment_list_type", "csv",
+        ]
+        if config["container"] == "mp4":
+            # fragmented so a segment cut short by a power loss is still playable
+            args += ["-segment_format", "mp4", "-segment_format_options", "movflags=+frag_keyframe+empty_moov+default_base_moof"]
+        else:
+            args += ["-segment_format", "matroska"]
+        args.append(os.path.join(segment_dir, f"part_%05d.{config['container']}"))
+        return args
+
+    def getNextPicturePath(self, suffix=""):
         picture_dir = os.path.join(self.root, "pictures")
         # picasso/pictures/MonthFullNameYYYY/dayNumberHHMMSS.jpg
         now = time.localtime()
         month_full_name = time.strftime("%B", now)
         day_number = time.strftime("%d", now)
         time_str = time.strftime("%I_%M_%S_%p", now)
-        picture_path = os.path.join(picture_dir, f"{month_full_name}{now.tm_year}/{day_number}__{time_str}.jpg")
+        base_path = os.path.join(picture_dir, f"{month_full_name}{now.tm_year}/{day_number}__{time_str}{self.file_tag}")
+        picture_path = f"{base_path}{suffix}.jpg"
+        # several pictures within the same second must not overwrite each other
+        n = 2
+        while os.path.exists(picture_path):
+            picture_path = f"{base_path}_{n}{suffix}.jpg"
+            n += 1
         if not os.path.exists(picture_path):
             self.makeIfNotDir(os.path.dirname(picture_path))
         return picture_path
@@ -309,110 +1724,411 @@ class CameraInterface:
         now = datetime.datetime.now().isoformat()
         self.metadata["start_time"] = now
         self.logger.log("Started recording")
-        # ffmpeg -f v4l2 -video_size 1280x800 -i /dev/video0 -codec:v h264_omx -b:v 2048k webcam.mkv
         
-        next_video_path = self.getNextVideoPath()
-        output_path = None
-        if config["usb_mode"]:
-            self._temp_output_path = self._getTempPath()
-            output_path = self._temp_output_path
-        else:
-            output_path = next_video_path
+        self._segment_mover = None
+        # with pre-roll the take copies that encoder's stream, whatever profile it runs
+        profile = self._preroll.profile if self._preroll else config["encoder_profile"]
+        if config["segment_seconds"] > 0:
+            take_dir = self.getNextTakeDir()
+            if config["usb_mode"]:
+                # segments land on the main drive first and get moved over while we keep recording
+                segment_dir = os.path.splitext(self._getTempPath())[0]
+                self.makeIfNotDir(segment_dir)
+            else:
+                segment_dir = take_dir
             self._temp_output_path = None
-        proc = subprocess.Popen([
+            self._take_path = take_dir
+            list_path = os.path.join(segment_dir, "segments.csv")
+            output_args = self._segment_output_args(segment_dir, list_path, encoding=self._preroll is None)
+            self._segment_mover = SegmentMover(list_path, segment_dir, take_dir, {
+                "take": os.path.basename(take_dir),
+                "start_time": now,
+                "resolution": config["resolution"],
+                "fps": config["fps"],
+                "encoder": self.encoder,
+                "encoder_profile": profile,
+                "segment_seconds": config["segment_seconds"],
+                "preroll_seconds": config["preroll_seconds"],
+            }, camera_metrics=self.metrics)
+        else:
+            next_video_path = self.getNextVideoPath()
+            self._take_path = next_video_path
+            output_path = None
+            if config["usb_mode"]:
+                self._temp_output_path = self._getTempPath()
+                output_path = self._temp_output_path
+                # start copying to the usb drive right away, stop only has to copy the tail
+                self._copier = IncrementalCopier(output_path, next_video_path, camera_metrics=self.metrics)
+            else:
+                output_path = next_video_path
+                self._temp_output_path = None
+            output_args = [*CONTAINER_ARGS[config["container"]], output_path]
+        self.metadata["encoder"] = {
+            "name": self.encoder,
+            "profile": profile,
+        }
+        proc = None
+        try:
+            if self._preroll:
+                # the pre-roll encoder already has the stream, the take only remuxes it
+                proc = subprocess.Popen([
+                    "ffmpeg",
+                    *PROGRESS_ARGS,
+                    "-fflags", "+genpts",
+                    "-f", "mpegts",
+                    "-i", "-",
+                    "-c", "copy",
+                    *output_args
+                ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                self._preroll_sink = self._preroll.attach(proc)
+            else:
+                proc = subprocess.Popen([
+                    "ffmpeg",
+                    *PROGRESS_ARGS,
+                    *self._input_args(),
+                    *self._rate_args(),
+                    *encoder_args(self.encoder, config["encoder_profiles"][profile]),
+                    *output_args
+                ], stdin=subprocess.PIPE if config["recording_backend"] == "pipe" else None,
+                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) # TODO: add to log files l8r m8
+                if config["recording_backend"] == "pipe":
+                    self._raw_writer = RawFrameWriter(proc, (self.height, self.width, 3), dropped_counter=self.metrics.recording_dropped_frames)
+        except (BrokenPipeError, ValueError, OSError) as e:
+            self.logger.error(f"Could not start recording: {e}")
+            self._abort_recording(proc)
+            raise
+        threading.Thread(target=follow_encoder_progress, args=(proc, self.metrics), daemon=True).start()
+        self._ffmpeg_pid = proc.pid
+        self._ffmpeg_proc = proc
+        if self._segment_mover:
+            self._segment_mover.start()
+        if self._copier:
+            self._copier.start()
+        self.publish_metadata()
+
+    def _abort_recording(self, proc):
+        # back to how it was before start_recording, the take never started
+        if proc:
+            proc.kill()
+            proc.wait()
+        self.metadata["recording"] = False
+        self._ffmpeg_proc = None
+        self._ffmpeg_pid = None
+        self._raw_writer = None
+        self._preroll_sink = None
+        self._segment_mover = None
+        self._copier = None
+        self._temp_output_path = None
+        self._take_path = None
+        self.publish_metadata()
+
+    def _preroll_command(self, profile):
+        return [
             "ffmpeg",
+            *self._input_args(),
+            *self._rate_args(),
+            *encoder_args(self.encoder, config["encoder_profiles"][profile]),
+            "-f", "mpegts",
+            "-"
+        ]
+
+    def update_encoder_profile(self):
+        """
+        Catches up with config["encoder_profile"] when not recording, the current take keeps
+        its settings and stop_recording calls this again. With pre-roll every take is a copy
+        of the pre-roll encoder's stream, so that encoder restarts with the new profile
+        """
+        if self.metadata["recording"]:
+            return
+        profile = config["encoder_profile"]
+        if self._preroll and self._preroll.profile != profile:
+            self.logger.log(f"Restarting the pre-roll encoder with profile {profile}")
+            self._preroll.restart(self._preroll_command(profile), profile)
+        self.metadata["encoder"] = {
+            "name": self.encoder,
+            "profile": profile,
+        }
+        self.publish_metadata()
+
+    def _input_args(self):
+        if config["recording_backend"] == "pipe":
+            # frames come straight from on_frame, skipping the loopback round trip. They are
+            # stamped when they arrive, a counted frame rate would shorten the take by every
+            # frame the writer dropped
+            return [
+                "-f", "rawvideo",
+                "-pix_fmt", "bgr24",
+                "-video_size", config["resolution"],
+                "-framerate", str(config["fps"]),
+                "-use_wallclock_as_timestamps", "1",
+                "-i", "-",
+            ]
+        return [
             "-f", "v4l2",
             "-video_size", config["resolution"],
-            "-i", "/dev/video40",
-            # "-c:v", "h264_omx",
-            "-c:v", config["encoding_format"],
-            "-b:v", "2048k",
-            output_path
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) # TODO: add to log files l8r m8
-        self._ffmpeg_pid = proc.pid
-    
-    def _move_thread(self, from_path, to_path):
-        shutil.move(from_path, to_path)
+            "-i", self.virtual_device,
+        ]
+
+    def _rate_args(self):
+        # recordings of piped frames come out at a constant rate, gaps left by dropped
+        # frames are filled by repeating the one before so the duration stays real time
+        if config["recording_backend"] == "pipe":
+            return ["-fps_mode", "cfr", "-r", str(config["fps"])]
+        return []
 
-    def metadata_track_filemove(self, from_path, to_path):
-        # move the file, wait for the to_path file size to be equal to from_path file size
-        original_size = os.path.getsize(from_path)
+    def _update_saving(self):
+        # /metadata["saving"] mirrors the job queue, complete once nothing is left to save
+        job = self.jobs.current
+        pending = self.jobs.pending("save_recording")
         self.metadata['saving'] = {
-            "complete": False,
-            "total_bytes": original_size,
-            "moved_bytes": 0,
+            "complete": len(pending) == 0,
+            "total_bytes": job.total_bytes if job else 0,
+            "moved_bytes": job.moved_bytes if job else 0,
+            "job_id": job.id if job else None,
+            "queued": len(pending),
         }
-        try:
-            # shutil.move(from_path, to_path)
-            threading.Thread(target=self._move_thread, args=(from_path, to_path), daemon=True).start()
-            self.logger.log(f"Moved recording to {to_path}")
-        except Exception as e:
-            self.logger.error(f"Failed to move recording to {to_path}: {e}")
-            return
-        # wait for the to_path file size to be equal to original_size
-        start_time = time.time()
+        self.publish_metadata()
+
+    def _stop_ffmpeg(self, proc, writer):
+        if writer:
+            # raw frames or the pre-roll stream, closing stdin lets ffmpeg finish the file on its own
+            writer.close()
+            if writer.dropped_frames:
+                self.logger.warn(f"Dropped {writer.dropped_frames} frames because the encoder could not keep up")
+        elif proc:
+            proc.send_signal(signal.SIGTERM)
+        if proc:
+            # everything after this reads the finished file
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.logger.error("ffmpeg did not exit in time, killing it")
+                proc.kill()
+                proc.wait()
+
+    def _finish_take(self, job, proc, writer, mover, copier, take_path):
+        self._stop_ffmpeg(proc, writer)
+        def on_progress(moved_bytes, total_bytes):
+            job.progress(moved_bytes, total_bytes)
+            self._update_saving()
+        if mover:
+            mover.take_info["stop_time"] = datetime.datetime.now().isoformat()
+            manifest_path = mover.finish()
+            on_progress(mover.moved_bytes, mover.moved_bytes)
+            self.add_to_library(mover.take_dir, "video")
+            return {"path": mover.take_dir, "manifest": manifest_path}
+        if copier:
+            copier.on_progress = on_progress
+            on_progress(copier.copied_bytes, os.path.getsize(copier.from_path) if os.path.exists(copier.from_path) else 0)
+            copier.finish()
+            self.logger.log(f"Moved recording to {copier.to_path}")
+            take_path = copier.to_path
+        self.add_to_library(take_path, "video")
+        result = {"path": take_path}
+        if config["faststart_remux"] and take_path.endswith(".mp4"):
+            # queued behind this job, the next take can already be recording
+            result["remux_job_id"] = self.jobs.submit("remux", lambda remux_job: self._remux_faststart(remux_job, take_path)).id
+        return result
+
+    def _remux_faststart(self, job, path):
+        """
+        Rewrites a fragmented mp4 as a regular one with the moov index at the front, which
+        seeks better in browsers and editors. Stream copy, so it costs disk time and no cpu.
+        The fragmented file is only replaced once the new one is complete
+        """
+        tmp_path = f"{path}.remux.tmp"
+        total_bytes = os.path.getsize(path)
+        proc = subprocess.Popen([
+            "ffmpeg", "-v", "error", "-y",
+            "-i", path,
+            "-map", "0", "-c", "copy",
+            "-movflags", "+faststart",
+            "-f", "mp4", tmp_path
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         while True:
-            if os.path.exists(to_path):
-                new_size = os.path.getsize(to_path)
-                if new_size == original_size:
-                    self.logger.log(f"File move complete: {to_path}")
-                    self.metadata['saving']['moved_bytes'] = new_size
-                    self.metadata['saving']['complete'] = True
-                    break
-                self.metadata['saving']['moved_bytes'] = new_size
-            # if time.time() - start_time > 30: # this is bad because some drives are slow
-            #     self.logger.error(f"File move timeout after 30 seconds: {to_path}")
-            #     break
+            try:
+                proc.wait(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                # faststart moves the index up front at the very end, the size is close enough until then
+                job.progress(os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0, total_bytes)
+        if proc.returncode != 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise RuntimeError(f"ffmpeg failed to remux {path}: {proc.stderr.read().decode(errors='replace').strip()}")
+        os.replace(tmp_path, path)
+        job.progress(total_bytes, total_bytes)
+        self.logger.log(f"Remuxed {path} for faststart")
+        # new mtime, the index, thumbnail and playback caches catch up on their own
+        self.add_to_library(path, "video")
+        return {"path": path}
 
     def stop_recording(self):
+        """
+        Returns right away with the Job that finishes the take (stopping ffmpeg, moving the
+        file to USB), the next take can start while it is still running
+        """
         self.metadata["recording"] = False
+        self.metadata["end_time"] = datetime.datetime.now().isoformat()
         self.logger.log("Stopped recording")
-        if self._ffmpeg_pid:
-            os.kill(self._ffmpeg_pid, signal.SIGTERM)
-        if self._temp_output_path and config["usb_mode"]:
-            # move the temp file to the usb drive
-            next_video_path = self.getNextVideoPath()
-            self.metadata_track_filemove(self._temp_output_path, next_video_path)
-            self._temp_output_path = None
-        
+        if self._preroll:
+            self._preroll.detach()
+        # hand this take's state over to the job so a new take can start immediately
+        proc, writer, mover, copier = self._ffmpeg_proc, self._raw_writer or self._preroll_sink, self._segment_mover, self._copier
+        take_path = self._take_path
+        self._ffmpeg_proc = None
+        self._ffmpeg_pid = None
+        self._raw_writer = None
+        self._preroll_sink = None
+        self._segment_mover = None
+        self._copier = None
+        self._temp_output_path = None
+        self._take_path = None
+        # a profile picked while recording applies now
+        self.update_encoder_profile()
+        if proc is None:
+            return None
+
+        return self.jobs.submit("save_recording", lambda job: self._finish_take(job, proc, writer, mover, copier, take_path))
 
-    async def recv_frame(self):
+    def recv_frame(self):
         self.logger.log("Starting frame receiver")
-        with pyvirtualcam.Camera(
-            width=int(config["resolution"].split("x")[0]),
-            height=int(config["resolution"].split("x")[1]),
-            fps=config["fps"],
-            device=config["virtual_device"]["device"],
-            print_fps=False
-        ) as vcam:
-            while True:
-                ret, frame = self.cap.read()
-                if not ret or frame is None:
-                    self.logger.error("Failed to read frame from camera")
-                    frame = self._black_frame  # fallback
-                    self._failed_frame_count += 1
-                    if self._failed_frame_count >= 10:
-                        self.wait_for_camera()
-                        self._failed_frame_count = 0
-                        continue
-                else:
+        while True:
+            read_start = time.monotonic()
+            ret, frame = self.cap.read(self.frame_ring.next_slot())
+            if not ret or frame is None:
+                self.logger.error("Failed to read frame from camera")
+                frame = self._black_frame  # fallback
+                self._failed_frame_count += 1
+                self.metrics.capture_failed_reads.inc()
+                if self._failed_frame_count >= 10:
+                    self.wait_for_camera()
+                    self.metrics.capture_reopens.inc()
                     self._failed_frame_count = 0
-                self._cur_frame = frame
-                await self.on_frame(frame, vcam)
-    async def send_vframe(self, frame: np.ndarray, vcam: pyvirtualcam.Camera):
+                    continue
+            else:
+                self._failed_frame_count = 0
+                self.metrics.capture_frames.inc()
+                if self.tracer is not None:
+                    # the seq publish() below hands out, this is the only thread publishing
+                    self.tracer.captured(self.frame_notifier.seq + 1, read_start, time.monotonic())
+                self.frame_ring.commit(frame)
+                burst = self._burst
+                if burst is not None and burst.add(frame):
+                    self._burst = None
+                    self._encode_burst(burst)
+            self._cur_frame = frame
+            self.frame_notifier.publish()
+
+    def recv_shared_frames(self):
+        """
+        recv_frame for capture_process, the frames are already in shared memory so this only
+        follows the capture process' sequence numbers and hands out read-only views of them
+        """
+        self.logger.log(f"Following capture process for {self.device}")
+        ring = self._capture.ring
+        last_seq = ring.latest_seq
+        while True:
+            seq = self._capture.wait(timeout=1.0)
+            if seq is None:
+                if not self._capture.alive():
+                    self.logger.error("Capture process died, restarting it")
+                    self._capture.restart()
+                else:
+                    self.logger.error("No frames from the capture process")
+                self._cur_frame = self._black_frame
+                self.frame_notifier.publish()
+                continue
+            if seq > last_seq:
+                # every frame the capture process read, picked up or not
+                self.metrics.capture_frames.inc(seq - last_seq)
+                self.metrics.follower_skipped_frames.inc(seq - last_seq - 1)
+            last_seq = seq
+            frame = ring.frame(seq)
+            if frame is None:
+                self.metrics.follower_skipped_frames.inc()
+                continue # already overwritten, the next wait returns a newer one
+            if self.tracer is not None:
+                capture_time = ring.capture_time(seq)
+                if capture_time is not None:
+                    trace_seq = self.frame_notifier.seq + 1
+                    self.tracer.captured(trace_seq, capture_time, capture_time)
+                    # getting the frame from the capture process over to us
+                    self.tracer.span("handoff", trace_seq, capture_time, time.monotonic())
+            if self.capture_format is None and ring.capture_format() is not None:
+                self.capture_format = ring.capture_format()
+                self.metadata["capture_format"] = self.capture_format
+                self.publish_metadata()
+            burst = self._burst
+            if burst is not None and burst.add(frame):
+                self._burst = None
+                self._encode_burst(burst)
+            self._cur_frame = frame
+            self.frame_notifier.publish()
+
+    def run_output_writer(self):
+        self.logger.log("Starting output writer")
+        vcam = None
+        if self.virtual_camera_enabled and config["virtual_camera_backend"] == "null":
+            vcam = NullVirtualCamera(self.width, self.height, config["fps"])
+        elif self.virtual_camera_enabled:
+            # opencv frames are BGR, let pyvirtualcam take them as is instead of converting every frame
+            vcam = pyvirtualcam.Camera(
+                width=self.width,
+                height=self.height,
+                fps=config["fps"],
+                fmt=pyvirtualcam.PixelFormat.BGR,
+                device=self.virtual_device,
+                print_fps=False
+            )
+        try:
+            seq = 0
+            while True:
+                # paced by the camera, if we fall behind we skip to the newest frame
+                new_seq = self.frame_notifier.wait(seq, timeout=1.0)
+                if new_seq == seq:
+                    continue
+                if seq > 0 and new_seq > seq + 1:
+                    self.metrics.output_skipped_frames.inc(new_seq - seq - 1)
+                seq = new_seq
+                self.on_frame(self._cur_frame, vcam, seq)
+        finally:
+            if vcam is not None:
+                vcam.close()
+
+    def send_vframe(self, frame: np.ndarray, vcam: pyvirtualcam.Camera):
+        start = time.perf_counter()
         vcam.send(frame)
-        vcam.sleep_until_next_frame()
+        self.metrics.vcam_send_seconds.observe(time.perf_counter() - start)
 
-    async def on_frame(self, frame: np.ndarray, vcam: pyvirtualcam.Camera):
+    def on_frame(self, frame: np.ndarray, vcam: pyvirtualcam.Camera, seq=None):
+        # monotonic like the tracer's stamps
+        start = time.monotonic()
         if frame is None or frame.size == 0:
             self.logger.error("Received empty frame in on_frame")
             frame = self._black_frame
-        frame = cv2.resize(frame, (
-            int(config["resolution"].split("x")[0]),
-            int(config["resolution"].split("x")[1])
-        ))
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        await self.send_vframe(frame, vcam)
+        if frame.shape[0] != self.height or frame.shape[1] != self.width:
+            # only when the camera did not give us the configured resolution, into a reused buffer
+            frame = cv2.resize(frame, (self.width, self.height), dst=self._resize_buffer)
+            resize_end = time.monotonic()
+            self.metrics.resize_seconds.observe(resize_end - start)
+            if self.tracer is not None and seq is not None:
+                self.tracer.span("resize", seq, start, resize_end)
+        if vcam is not None:
+            vcam_start = time.monotonic()
+            self.send_vframe(frame, vcam)
+            if self.tracer is not None and seq is not None:
+                self.tracer.span("vcam", seq, vcam_start, time.monotonic())
+        writer = self._raw_writer
+        if writer is not None:
+            writer.write(frame)
+        preroll_writer = self._preroll.writer if self._preroll else None
+        if preroll_writer is not None:
+            preroll_writer.write(frame)
+        preview_writer = self.h264_preview.writer
+        if preview_writer is not None:
+            preview_writer.write(frame)
+        self.metrics.output_frame_seconds.observe(time.monotonic() - start)
 
 
     # OLD EXAMPLE
@@ -423,33 +2139,264 @@ class CameraInterface:
     #                b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
 
     async def _get_web_stream(self, request: Request):
-        import time
-        last_frame_time = 0
-        target_fps = 60  # Lower FPS for smoother streaming and HALF the resolution
-        encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), config["preview_quality"]]
-        # half
-        while await request.is_disconnected() is False:
-            now = time.time()
-            if now - last_frame_time < 1.0 / target_fps:
-                await asyncio.sleep(0.01)
-                continue
-            last_frame_time = now
-            frame = self._cur_frame if self._cur_frame is not None else self._black_frame
-            frame = cv2.resize(frame, (frame.shape[1] // 2, frame.shape[0] // 2))
-            ret, buffer = cv2.imencode('.jpg', frame, encode_params)
-            if not ret:
-                await asyncio.sleep(0.01)
-                continue
-            yield (b'--frame\r\n'
-                b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+        # every client shares the same encoded frames, see PreviewBroadcaster
+        client = self.preview_broadcaster.subscribe()
+        sent_bytes = self.metrics.client_sent_bytes("mjpeg", client.id)
+        try:
+            while await request.is_disconnected() is False:
+                try:
+                    seq, chunk = await asyncio.wait_for(client.queue.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    continue
+                flush_start = time.monotonic()
+                # this only returns once the server could hand the bytes to the socket,
+                # so a slow link makes the queue fill up and the broadcaster notices
+                yield chunk
+                if self.tracer is not None:
+                    self.tracer.span("flush", seq, flush_start, time.monotonic(), track=f"client {client.id}")
+                sent_bytes.inc(len(chunk))
+                self.metrics.mjpeg_sent_bytes.inc(len(chunk))
+        finally:
+            self.preview_broadcaster.unsubscribe(client)
+            self.metrics.remove_client("mjpeg", client.id)
+
+    async def next_frame(self, timeout=1.0):
+        # the first frame captured after this call, never one that was already there
+        seq = self.frame_notifier.seq
+        await self.frame_notifier.wait_async(seq, timeout=timeout)
+        return self._cur_frame if self._cur_frame is not None else self._black_frame
 
     async def take_picture(self):
         picture_path = self.getNextPicturePath()
-        frame = self._cur_frame if self._cur_frame is not None else self._black_frame
-        cv2.imwrite(picture_path, frame)
+        frame = await self.next_frame()
+        # copied since the capture thread will reuse the buffer while we encode
+        await self.encode_pool.run(cv2.imwrite, picture_path, frame.copy())
         self.logger.log(f"Saved picture to {picture_path}")
+        await asyncio.to_thread(self.add_to_library, picture_path, "picture")
         return (picture_path, os.path.getsize(picture_path)) # size in bytes
 
+    def take_burst(self, count):
+        """
+        Starts capturing the next count frames and returns their jobs right away, one per
+        picture. Frames are grabbed at the camera's frame rate and encoded in the
+        background, poll /jobs/{id} for the saved path
+        """
+        if self._burst is not None:
+            return None
+        jobs = [self.jobs.register("picture") for _ in range(count)]
+        # twice as long as it should take, plus time for a slow first frame
+        burst = BurstCapture(count, self.frame_ring.next_slot().shape, jobs, timeout=count * 2 / config["fps"] + 5)
+        self._burst = burst
+        timer = threading.Timer(burst.timeout, self._expire_burst, args=(burst,))
+        timer.daemon = True
+        timer.start()
+        self.logger.log(f"Capturing a burst of {count} pictures")
+        return jobs
+
+    def _expire_burst(self, burst: BurstCapture):
+        if not burst.close():
+            return # filled up in time
+        if self._burst is burst:
+            self._burst = None
+        self.logger.error(f"Burst got {burst.captured} of {len(burst.jobs)} frames before its deadline")
+        for job in burst.jobs[burst.captured:]:
+            job.error = "No frame from the camera before the burst deadline"
+            job.status = "failed"
+            job.finished_time = datetime.datetime.now().isoformat()
+        self._encode_burst(burst)
+
+    def _encode_burst(self, burst: BurstCapture):
+        # runs on the capture thread (or the deadline timer), only hands the work to the encode pool
+        for i, job in enumerate(burst.jobs[:burst.captured]):
+            self.encode_pool.submit(self._save_burst_picture, job, f"_{i + 1:03d}", burst.frames[i])
+
+    def _save_burst_picture(self, job: Job, suffix, frame: np.ndarray):
+        try:
+            picture_path = self.getNextPicturePath(suffix)
+            if not cv2.imwrite(picture_path, frame):
+                raise IOError(f"Failed to write {picture_path}")
+            job.result = {"path": picture_path, "size_bytes": os.path.getsize(picture_path)}
+            self.add_to_library(picture_path, "picture")
+            job.status = "done"
+        except Exception as e:
+            self.logger.error(f"Failed to save burst picture: {e}")
+            job.error = str(e)
+            job.status = "failed"
+        job.finished_time = datetime.datetime.now().isoformat()
+
+class PreviewClient:
+    def __init__(self, queue_size, step_up_after):
+        self.id = uuid.uuid4().hex[:8]
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.level = 0 # index into the preview ladder, 0 is the best
+        self.offered = 0
+        self.dropped = 0
+        self.clean_frames = 0
+        self.step_up_after = step_up_after
+
+class PreviewBroadcaster:
+    """
+    Encodes the preview once per new camera frame and fans the same JPEG bytes out
+    to every /stream client. Each client gets a small bounded queue, when a client
+    is too slow to keep up its oldest queued frame is dropped instead of stalling
+    the producer or encoding again just for that client.
+
+    Those drops are also how a slow link is detected: a client dropping too many frames
+    steps down the preview ladder (smaller, lower quality, fewer fps) and steps back up
+    after a while without drops. Each rung is only encoded while someone is watching it
+    """
+    def __init__(self, camera: CameraInterface, ladder, queue_size=2, window=30, step_up_after=90, max_step_up_after=90 * 8):
+        self.logger = Logger('PreviewBroadcaster')
+        self.camera = camera
+        self.ladder = [{
+            "scale": rung["scale"],
+            "fps_divisor": rung["fps_divisor"],
+            "encode_params": [int(cv2.IMWRITE_JPEG_QUALITY), rung["quality"] if rung["quality"] is not None else config["preview_quality"]],
+        } for rung in ladder]
+        self.queue_size = queue_size
+        self.window = window
+        self.step_up_after = step_up_after
+        self.max_step_up_after = max_step_up_after
+        self._subscribers = set()
+        self._latest_chunks = [None] * len(self.ladder)
+        self._task = None
+        self._frame = None # what gets encoded, the capture thread reuses its buffers
+        self._encode_seconds = [camera.metrics.preview_encode_seconds(level) for level in range(len(self.ladder))]
+
+    def subscribe(self):
+        client = PreviewClient(self.queue_size, self.step_up_after)
+        if self._latest_chunks[0] is not None:
+            # new viewers get the last frame right away instead of waiting for the next one
+            client.queue.put_nowait(self._latest_chunks[0])
+        self._subscribers.add(client)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return client
+
+    def unsubscribe(self, client: PreviewClient):
+        self._subscribers.discard(client)
+
+    def _offer(self, client: PreviewClient, chunk):
+        # chunk is (frame seq, bytes)
+        dropped = False
+        if client.queue.full():
+            # slow client, drop its stale frame so it always gets the newest one
+            try:
+                client.queue.get_nowait()
+                dropped = True
+                self.camera.metrics.mjpeg_dropped_frames.inc()
+            except asyncio.QueueEmpty:
+                pass
+        client.queue.put_nowait(chunk)
+        self._adapt(client, dropped)
+
+    def _adapt(self, client: PreviewClient, dropped):
+        client.offered += 1
+        if dropped:
+            client.dropped += 1
+            client.clean_frames = 0
+        else:
+            client.clean_frames += 1
+        if client.offered >= self.window:
+            if client.dropped * 5 > client.offered and client.level < len(self.ladder) - 1:
+                client.level += 1
+                # stepping down again right after stepping up means the link cannot take it,
+                # wait longer before the next try
+                client.step_up_after = min(client.step_up_after * 2, self.max_step_up_after)
+                client.clean_frames = 0
+            client.offered = 0
+            client.dropped = 0
+        elif client.clean_frames >= client.step_up_after and client.level > 0:
+            client.level -= 1
+            client.clean_frames = 0
+
+    async def _run(self):
+        self.logger.log("Starting preview producer")
+        seq = -1
+        while self._subscribers:
+            # only encode when the capture thread has published a new frame
+            new_seq = await self.camera.frame_notifier.wait_async(seq, timeout=1.0)
+            if new_seq == seq:
+                continue
+            seq = new_seq
+            frame = self.camera._cur_frame if self.camera._cur_frame is not None else self.camera._black_frame
+            # copied while the ring slot still holds this seq, encoding takes long enough for it to be reused
+            if self._frame is None or self._frame.shape != frame.shape:
+                self._frame = np.empty_like(frame)
+            np.copyto(self._frame, frame)
+            frame = self._frame
+            # grouped up front, a client that changes level below waits for the next frame
+            watchers = {}
+            for client in self._subscribers:
+                watchers.setdefault(client.level, []).append(client)
+            levels = [level for level, rung in enumerate(self.ladder) if level in watchers and seq % rung["fps_divisor"] == 0]
+            # all watched rungs encode in parallel on the preview pool, the loop only moves bytes
+            encode_start = time.monotonic()
+            jpegs = await asyncio.gather(*[
+                self.camera.preview_pool.run(encode_jpeg, frame, self.ladder[level]["scale"], self.ladder[level]["encode_params"], self._encode_seconds[level])
+                for level in levels
+            ])
+            if self.camera.tracer is not None and levels:
+                # includes waiting for the pool, that is latency a viewer sees too
+                self.camera.tracer.span("preview_encode", seq, encode_start, time.monotonic())
+            for level, jpeg in zip(levels, jpegs):
+                if jpeg is None:
+                    continue
+                chunk = (seq, b'--frame\r\n'
+                    b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+                self._latest_chunks[level] = chunk
+                for client in watchers[level]:
+                    self._offer(client, chunk)
+        self._latest_chunks = [None] * len(self.ladder)
+        self.logger.log("No more preview clients, stopping preview producer")
+
+class CameraRegistry:
+    """
+    Every configured camera by id. Each one is a full CameraInterface with its own capture
+    thread, ffmpeg encoders, loopback device and preview, so cpu and memory grow by one
+    camera's worth per camera. The media library and the encoder probe are shared
+    """
+    def __init__(self, camera_configs):
+        self.logger = Logger('CameraRegistry')
+        # only the real loopback devices need the kernel module (and sudo)
+        needs_loopback = config["virtual_camera"] and config["virtual_camera_backend"] == "v4l2loopback"
+        if needs_loopback and not load_loopback_devices(camera_configs) and config["recording_backend"] == "loopback":
+            sys.exit(1)
+        self.cameras = {}
+        shared = {}
+        for camera_config in camera_configs:
+            camera = CameraInterface(camera_config["id"], camera_config["device"], camera_config["virtual_device"], **shared)
+            shared = {
+                "media_index": camera.media_index,
+                "thumbnails": camera.thumbnails,
+                "available_encoders": camera.available_encoders,
+            }
+            self.cameras[camera.id] = camera
+        self.default = next(iter(self.cameras.values()))
+        self.logger.log(f"Opened {len(self.cameras)} camera(s): {', '.join(self.cameras)}")
+
+    def get(self, camera_id):
+        return self.cameras.get(camera_id)
+
+    def start(self):
+        for camera in self.cameras.values():
+            camera.start()
+        threading.Thread(target=self.reconcile_media_index, daemon=True).start()
+
+    def reconcile_media_index(self):
+        # catches files added or removed while picasso was not running
+        try:
+            self.logger.log(f"Media index: {self.default.media_index.reconcile()}")
+        except Exception as e:
+            self.logger.error(f"Failed to reconcile media index: {e}")
+
+    def find_job(self, job_id):
+        for camera in self.cameras.values():
+            job = camera.jobs.get(job_id)
+            if job is not None:
+                return job
+        return None
+
 app = FastAPI(docs_url=None)
 app.add_middleware(
     CORSMiddleware,
@@ -458,19 +2405,27 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-camera = CameraInterface()
+cameras = CameraRegistry(configured_cameras())
+# the routes without /cameras/{camera_id} act on the first camera
+camera = cameras.default
+
+cameras.start()
 
-def run_camera():
-    asyncio.run(camera.recv_frame())
-threading.Thread(target=run_camera, daemon=True).start()
+def camera_not_found(camera_id):
+    return JSONResponse(content={"error": f"Camera not found: {camera_id}"}, status_code=404)
 
 # add middleware to check for passcode in header for all routes
 
 #test function to ensure middleware works
 @app.middleware("http")
 async def test(request: Request, call_next):
-    # bypass /stream
-    if request.url.path == "/stream":
+    # /cameras/{camera_id}/stream is checked like /stream and so on
+    path = request.url.path
+    if path.startswith("/cameras/") and path.count("/") >= 3:
+        path = "/" + path.split("/", 3)[3]
+    # bypass /stream and /metadata/events, browsers cannot set headers on <img> and EventSource so they check ?passcode themselves
+    # /metrics too, prometheus can only be told to send a query parameter
+    if path in ["/stream", "/metadata/events", "/metrics"]:
         response = await call_next(request)
         return response
     # bypass options requests
@@ -484,7 +2439,7 @@ async def test(request: Request, call_next):
             response.headers["Access-Control-Allow-Origin"] = "*"
             response.headers["Access-Control-Allow-Headers"] = "*"
             return response
-        if request.url.path in ["/start_recording", "/stop_recording", "/take_picture"]:
+        if path in ["/start_recording", "/stop_recording", "/take_picture", "/take_burst", "/encoder_profile"]:
             if header_passcode != config["passcode"]:
                 response = JSONResponse(content={"error": "Unauthorized"}, status_code=401)
                 response.headers["Access-Control-Allow-Origin"] = "*"
@@ -493,28 +2448,216 @@ async def test(request: Request, call_next):
     response = await call_next(request)
     return response
 
-@app.get("/stream")
-async def stream(req: Request, passcode: str = None):
+@app.get("/cameras")
+async def list_cameras():
+    return JSONResponse(content={"default": cameras.default.id, "cameras": [{
+        "id": camera.id,
+        "device": camera.device,
+        "virtual_device": camera.virtual_device if camera.virtual_camera_enabled and config["virtual_camera_backend"] == "v4l2loopback" else None,
+        "recording": camera.metadata["recording"],
+        "capture_format": camera.capture_format,
+    } for camera in cameras.cameras.values()]})
+
+@app.get("/cameras/{camera_id}/stream")
+async def camera_stream(req: Request, camera_id: str, passcode: str = None):
     if config["secure"] and passcode != config["passcode"]:
         return JSONResponse(content={"error": "Unauthorized"}, status_code=401)
+    camera = cameras.get(camera_id)
+    if camera is None:
+        return camera_not_found(camera_id)
 
     return StreamingResponse(camera._get_web_stream(req), media_type='multipart/x-mixed-replace; boundary=frame')
 
+@app.get("/stream")
+async def stream(req: Request, passcode: str = None):
+    return await camera_stream(req, cameras.default.id, passcode)
+
+async def wait_for_disconnect(websocket: WebSocket):
+    # viewers never send anything, this only notices them leaving while no fragments come
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+@app.websocket("/cameras/{camera_id}/preview/ws")
+async def camera_preview_ws(websocket: WebSocket, camera_id: str, passcode: str = None):
+    # h264 in fragmented mp4, the first text message is the codec string for MediaSource
+    camera = cameras.get(camera_id)
+    if (config["secure"] and passcode != config["passcode"]) or camera is None:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        client = camera.h264_preview.subscribe()
+    except OSError as e:
+        camera.logger.error(f"Could not start the h264 preview: {e}")
+        await websocket.close(code=1011)
+        return
+    sent_bytes = camera.metrics.client_sent_bytes("h264", client.id)
+    disconnected = asyncio.create_task(wait_for_disconnect(websocket))
+    try:
+        sent_codec = False
+        while True:
+            try:
+                segment = await asyncio.wait_for(client.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                if disconnected.done():
+                    break
+                continue
+            if segment is None:
+                # the encoder died, the viewer reconnects and gets a new one
+                await websocket.close(code=1011)
+                break
+            if not sent_codec:
+                await websocket.send_text(camera.h264_preview.codec or "avc1.42E01F")
+                sent_codec = True
+            await websocket.send_bytes(segment)
+            sent_bytes.inc(len(segment))
+            camera.metrics.h264_sent_bytes.inc(len(segment))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        disconnected.cancel()
+        camera.h264_preview.unsubscribe(client)
+        camera.metrics.remove_client("h264", client.id)
+
+@app.websocket("/preview/ws")
+async def preview_ws(websocket: WebSocket, passcode: str = None):
+    await camera_preview_ws(websocket, cameras.default.id, passcode)
+
+@app.get('/cameras/{camera_id}/start_recording')
+async def camera_start_recording(camera_id: str):
+    camera = cameras.get(camera_id)
+    if camera is None:
+        return camera_not_found(camera_id)
+    try:
+        # spawns ffmpeg and writes the pre-roll into it, not something for the event loop
+        await asyncio.to_thread(camera.start_recording)
+    except (BrokenPipeError, ValueError, OSError) as e:
+        return JSONResponse(content={"error": f"Could not start recording: {e}", 'metadata': camera.metadata}, status_code=500)
+    return JSONResponse(content={"status": "recording started", 'metadata': camera.metadata})
+
 @app.get('/start_recording')
 async def start_recording():
-    camera.start_recording()
-    return JSONResponse(content={"status": "recording started", 'metadata': camera.metadata})
+    return await camera_start_recording(cameras.default.id)
+
+@app.get('/cameras/{camera_id}/stop_recording')
+async def camera_stop_recording(camera_id: str):
+    # saving runs in the background, poll /jobs/{job_id} or watch /metadata["saving"]
+    camera = cameras.get(camera_id)
+    if camera is None:
+        return camera_not_found(camera_id)
+    job = camera.stop_recording()
+    return JSONResponse(content={"status": "recording stopped", "job_id": job.id if job else None, 'metadata': camera.metadata})
 
 @app.get('/stop_recording')
 async def stop_recording():
-    camera.stop_recording()
-    return JSONResponse(content={"status": "recording stopped", 'metadata': camera.metadata})
+    return await camera_stop_recording(cameras.default.id)
 
-@app.get('/take_picture')
-async def take_picture():
+@app.get('/cameras/{camera_id}/take_picture')
+async def camera_take_picture(camera_id: str):
+    camera = cameras.get(camera_id)
+    if camera is None:
+        return camera_not_found(camera_id)
     picture_path, size_bytes = await camera.take_picture()
     return JSONResponse(content={"status": "success", "path": picture_path, "size_bytes": size_bytes}, status_code=200)
 
+@app.get('/take_picture')
+async def take_picture():
+    return await camera_take_picture(cameras.default.id)
+
+@app.get('/cameras/{camera_id}/take_burst')
+async def camera_take_burst(camera_id: str, count: int = 10):
+    camera = cameras.get(camera_id)
+    if camera is None:
+        return camera_not_found(camera_id)
+    if count <= 0 or count > config["burst_max_frames"]:
+        return JSONResponse(content={"error": f"count must be between 1 and {config['burst_max_frames']}"}, status_code=400)
+    jobs = camera.take_burst(count)
+    if jobs is None:
+        return JSONResponse(content={"error": "A burst is already being captured"}, status_code=409)
+    # returns before the frames are even captured, poll /jobs/{id} for each picture
+    return JSONResponse(content={"status": "capturing", "ids": [job.id for job in jobs]})
+
+@app.get('/take_burst')
+async def take_burst(count: int = 10):
+    return await camera_take_burst(cameras.default.id, count)
+
+@app.get("/cameras/{camera_id}/metadata")
+async def get_camera_metadata(camera_id: str, passcode: str = None):
+    camera = cameras.get(camera_id)
+    if camera is None:
+        return camera_not_found(camera_id)
+    return JSONResponse(content={"metadata": camera.get_metadata()})
+
 @app.get("/metadata")
 async def get_metadata(passcode: str = None):
-    return JSONResponse(content={"metadata": camera.get_metadata()})
\ No newline at end of file
+    return await get_camera_metadata(cameras.default.id, passcode)
+
+@app.get("/cameras/{camera_id}/metadata/events")
+async def camera_metadata_events(req: Request, camera_id: str, passcode: str = None):
+    # server sent events, a message is only pushed when the metadata snapshot changed
+    if config["secure"] and passcode != config["passcode"]:
+        return JSONResponse(content={"error": "Unauthorized"}, status_code=401)
+    camera = cameras.get(camera_id)
+    if camera is None:
+        return camera_not_found(camera_id)
+
+    async def events():
+        seq = -1
+        while await req.is_disconnected() is False:
+            new_seq = await camera.metadata_notifier.wait_async(seq, timeout=15.0)
+            if new_seq == seq:
+                # keeps proxies and the browser from dropping an idle connection
+                yield ": keepalive\n\n"
+                continue
+            seq = new_seq
+            yield f"data: {json.dumps({'metadata': camera.get_metadata()})}\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/metadata/events")
+async def metadata_events(req: Request, passcode: str = None):
+    return await camera_metadata_events(req, cameras.default.id, passcode)
+
+@app.get("/metrics")
+async def get_metrics(passcode: str = None):
+    # prometheus text format, scrape with params: {passcode: [...]} when secure
+    if config["secure"] and passcode != config["passcode"]:
+        return JSONResponse(content={"error": "Unauthorized"}, status_code=401)
+    return PlainTextResponse(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/trace")
+async def get_trace():
+    # chrome trace json of every camera's recent frames, open in chrome://tracing or ui.perfetto.dev
+    tracers = [camera.tracer for camera in cameras.cameras.values() if camera.tracer is not None]
+    if not tracers:
+        return JSONResponse(content={"error": f"Frame tracing is off, enable frame_tracing in config located in {config_path}"}, status_code=404)
+    # can be tens of MB, keep the event loop free while it is serialized
+    body = await asyncio.to_thread(lambda: json.dumps(chrome_trace(tracers)))
+    return Response(body, media_type="application/json", headers={"Content-Disposition": f"attachment; filename=\"picasso_trace_{int(time.time())}.json\""})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    # job ids are unique across cameras
+    job = cameras.find_job(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return JSONResponse(content={"job": job.to_dict()})
+
+@app.get("/encoders")
+async def get_encoders():
+    return JSONResponse(content={
+        "available": cameras.default.available_encoders,
+        "selected": cameras.default.encoder,
+        "profile": config["encoder_profile"],
+        "profiles": config["encoder_profiles"],
+    })
+
+@app.get("/encoder_profile")
+async def set_encoder_profile(name: str):
+    if name not in config["encoder_profiles"]:
+        return JSONResponse(content={"error": f"Unknown encoder profile: {name}"}, status_code=400)
+    config["encoder_profile"] = name
+    save_config()
+    # takes effect on the next recording, the current take keeps its settings
+    for camera in cameras.cameras.values():
+        camera.update_encoder_profile()
+    return JSONResponse(content={"status": "success", "profile": name})
@@ -1,14 +1,20 @@
+import asyncio
 import fastapi
 import os
 import sys
 import subprocess
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
 #cors
 from fastapi.middleware.cors import CORSMiddleware
 import cv2
 import time
 
 import numpy as np
+import shutil
+import threading
+
+from picasso_media import MediaIndex, ThumbnailCache, VIDEO_MEDIA_TYPES, export_entries, iter_tar, iter_zip, tar_size
+from picasso_media import PLAYBACK_CACHE_SUFFIXES, PLAYBACK_CODECS, load_playback_index, load_sprite, playback_cache_path, playback_command, prepare_playback
 
 # if not "picasso" dir in ~/
 def makeIfNotDir(path):
@@ -19,14 +25,28 @@ makeIfNotDir(os.path.join(os.path.expanduser("~"), "picasso"))
 makeIfNotDir(os.path.join(os.path.expanduser("~"), "picasso", "videos"))
 makeIfNotDir(os.path.join(os.path.expanduser("~"), "picasso", "pictures"))
 
+media_index = MediaIndex(os.path.join(os.path.expanduser("~"), "picasso"))
+thumbnails = ThumbnailCache(os.path.join(os.path.expanduser("~"), "picasso"))
+
+def reconcile_media():
+    # catches files added or removed while the server was not running, the listing routes
+    # answer from what is already indexed until this is done
+    try:
+        print(f"Media index: {media_index.reconcile()}")
+        print(f"Pruned {thumbnails.prune(media_index.paths())} stale thumbnails")
+    except Exception as e:
+        print(f"Failed to reconcile media index: {e}")
+
+threading.Thread(target=reconcile_media, daemon=True).start()
+
 def getNextVideoPath():
     video_dir = os.path.join(os.path.expanduser("~"), "picasso", "videos")
-    # picasso/videos/MonthFullNameYYYY/dayNumberHHMMSS.avi
+    # picasso/videos/MonthFullNameYYYY/dayNumberHHMMSS.mkv
     now = time.localtime()
     month_full_name = time.strftime("%B", now)
     day_number = time.strftime("%d", now)
     time_str = time.strftime("%I_%M_%S_%p", now)
-    video_path = os.path.join(video_dir, f"{month_full_name}{now.tm_year}/{day_number}__{time_str}.avi")
+    video_path = os.path.join(video_dir, f"{month_full_name}{now.tm_year}/{day_number}__{time_str}{video_container}")
     if not os.path.exists(video_path):
         makeIfNotDir(os.path.dirname(video_path))
     return video_path
@@ -49,9 +69,11 @@ cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
 cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 cap.set(cv2.CAP_PROP_FPS, 30)
 fps = 30 # target fps for output video
+video_container = ".mkv" # unlike avi, an mkv cut off by a power loss still plays up to the last cluster
 actual_camera_fps = 30  # will be detected from camera
 recording = False
 video_writer = None
+recording_path = None
 recording_time_start = None
 frame_buffer = []
 last_frame_time = None
@@ -64,6 +86,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Start-Time"],
 )
 
 
@@ -174,7 +197,7 @@ async def gen_frames(request: fastapi.Request):
 
 @app.get("/start-recording")
 async def start_recording():
-    global recording, video_writer, cap, fps, recording_time_start, last_frame_time, frame_buffer
+    global recording, video_writer, cap, fps, recording_time_start, last_frame_time, frame_buffer, recording_path
     if recording:
         return JSONResponse(status_code=400, content={"error": "Recording already in progress"})
     
@@ -186,113 +209,149 @@ async def start_recording():
     recording_time_start = time.monotonic()
     fourcc = cv2.VideoWriter_fourcc(*'XVID')
     vid_path = getNextVideoPath()
+    recording_path = vid_path
     video_writer = cv2.VideoWriter(vid_path, fourcc, fps, (int(cap.get(3)), int(cap.get(4))))
 
     return JSONResponse(status_code=200, content={"message": "Recording started", "video_path": vid_path, "target_fps": fps, "camera_fps": actual_camera_fps})
 
 @app.get("/stop-recording")
 async def stop_recording():
-    global recording, video_writer, frame_buffer, last_frame_time
+    global recording, video_writer, frame_buffer, last_frame_time, recording_path
     if not recording:
         return JSONResponse(status_code=400, content={"error": "No recording in progress"})
     
     recording = False
+    duration = time.monotonic() - recording_time_start
     video_writer.release()
     video_writer = None
+    path = recording_path
+    recording_path = None
+    # probing the video can take seconds, not something for the event loop
+    await asyncio.to_thread(media_index.add, path, "video")
+    thumbnails.schedule(path, "video")
+    threading.Thread(target=prepare_playback, args=(path,), daemon=True).start()
     
     # Clear frame timing variables
     frame_buffer = []
     last_frame_time = None
 
-    return JSONResponse(status_code=200, content={"message": "Recording stopped", "duration": time.monotonic() - recording_time_start})
+    return JSONResponse(status_code=200, content={"message": "Recording stopped", "duration": duration})
 
 @app.get("/stream")
 async def stream_video(request: fastapi.Request):
     return StreamingResponse(gen_frames(request), media_type='multipart/x-mixed-replace; boundary=frame')
 
-def get_thumbnail(video_path: str):
-    if not os.path.exists(video_path):
-        return None
-    
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        return None
-    
-    # Get the frame at 1 second
-    cap.set(cv2.CAP_PROP_POS_MSEC, 1000)
-    ret, frame = cap.read()
-    cap.release()
-    
-    if not ret:
-        return None
-    
-    thumbnail_path = video_path.replace('.avi', '_thumbnail.jpg')
-    cv2.imwrite(thumbnail_path, frame)
-    
-    return thumbnail_path
+async def thumbnail_response(request: fastapi.Request, path: str, kind: str):
+    if not path or not os.path.exists(path):
+        return JSONResponse(status_code=404, content={"error": f"{kind.capitalize()} file not found"})
+    # the key only needs a stat, so a browser revalidating never costs a decode
+    key = thumbnails.key(path)
+    headers = {"ETag": f'"{key}"', "Cache-Control": "public, max-age=86400"}
+    if request.headers.get("if-none-match") == f'"{key}"':
+        return Response(status_code=304, headers=headers)
+    key, thumbnail_path = await asyncio.to_thread(thumbnails.get, path, kind)
+    if not thumbnail_path:
+        return JSONResponse(status_code=500, content={"error": "Thumbnail could not be created"})
+    return FileResponse(thumbnail_path, media_type='image/jpeg', headers=headers)
 
 # ?path=video_path
 @app.get('/video-thumbnail')
-async def video_thumbnail(path: str):
-    if not path:
-        return JSONResponse(status_code=400, content={"error": "No video path provided"})
-    
-    thumbnail_path = get_thumbnail(path)
-    if not thumbnail_path:
-        return JSONResponse(status_code=404, content={"error": "Thumbnail could not be created"})
-    
-    return FileResponse(thumbnail_path, media_type='image/jpeg')
+async def video_thumbnail(request: fastapi.Request, path: str):
+    return await thumbnail_response(request, path, "video")
 
 @app.get("/picture-thumbnail")
-async def picture_thumbnail(path: str):
+async def picture_thumbnail(request: fastapi.Request, path: str):
+    return await thumbnail_response(request, path, "picture")
+
+@app.get("/playback/index")
+async def playback_index(path: str):
+    # keyframes (take time and byte offset) and segments, for seeking without downloading
     if not path or not os.path.exists(path):
-        return JSONResponse(status_code=404, content={"error": "Picture file not found"})
-    
-    # Create a thumbnail by resizing the image to 200x200
-    img = cv2.imread(path)
-    if img is None:
-        return JSONResponse(status_code=500, content={"error": "Failed to read image"})
-    
-    print(path)
-    if os.path.exists(path.replace('.jpg', '_thumbnail.jpg')):
-        print("Thumbnail already exists, returning existing thumbnail")
-        return FileResponse(path.replace('.jpg', '_thumbnail.jpg'), media_type='image/jpeg')
+        return JSONResponse(status_code=404, content={"error": "Video file not found"})
+    index = await asyncio.to_thread(load_playback_index, path)
+    return JSONResponse(status_code=200, content={
+        "codec": index["codec"],
+        "width": index["width"],
+        "height": index["height"],
+        "duration": index["duration"],
+        # h264 in a faststart mp4 plays straight from /download-video and seeks with Range
+        # requests, anything else (mkv, takes, fragmented mp4) goes through /playback/stream
+        "direct": index["codec"] in PLAYBACK_CODECS and index.get("faststart", False),
+        "segments": index["segments"],
+        "keyframes": index["keyframes"],
+        "sprite": index["sprite"],
+    })
 
-    thumbnail = cv2.resize(img, (200, 200))
-    thumbnail_path = path.replace('.jpg', '_thumbnail.jpg')
-    cv2.imwrite(thumbnail_path, thumbnail)
-    
-    return FileResponse(thumbnail_path, media_type='image/jpeg')
+# ?path=video_path&start=seconds&duration=seconds
+@app.get("/playback/stream")
+async def playback_stream(path: str, start: float = 0.0, duration: float = 10.0):
+    if not path or not os.path.exists(path):
+        return JSONResponse(status_code=404, content={"error": "Video file not found"})
+    index = await asyncio.to_thread(load_playback_index, path)
+    if not index["segments"]:
+        return JSONResponse(status_code=404, content={"error": "Take has no segments"})
+    command, actual_start = playback_command(path, index, max(0.0, start), max(0.1, duration))
+    proc = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    async def read_fragments():
+        try:
+            while chunk := await proc.stdout.read(256 * 1024):
+                yield chunk
+        finally:
+            # the player seeked away before this one finished
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+
+    # the player needs to know where the keyframe put the start
+    return StreamingResponse(read_fragments(), media_type="video/mp4", headers={"X-Start-Time": f"{actual_start:.3f}"})
+
+@app.get("/playback/sprite")
+async def playback_sprite(path: str, interval: int = 10):
+    # tile layout is in /playback/index under sprite once this has been built
+    if not path or not os.path.exists(path):
+        return JSONResponse(status_code=404, content={"error": "Video file not found"})
+    if interval < 1:
+        return JSONResponse(status_code=400, content={"error": "interval must be at least 1 second"})
+    sprite_path, sprite = await asyncio.to_thread(load_sprite, path, interval)
+    if not sprite_path:
+        return JSONResponse(status_code=500, content={"error": "Sprite could not be created"})
+    return FileResponse(sprite_path, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=86400"})
 
 @app.get("/video-files")
-async def get_video_files():
-    video_dir = os.path.join(os.path.expanduser("~"), "picasso", "videos")
-    if not os.path.exists(video_dir):
-        return JSONResponse(status_code=404, content={"error": "No videos found"})
-    
-    video_files = []
-    # recursively find all .avi files in the video directory
-    for root, dirs, files in os.walk(video_dir):
-        for file in files:
-            if file.endswith('.avi'):
-                video_files.append(os.path.join(root, file))
-    return JSONResponse(status_code=200, content={"video_files": video_files})
+async def get_video_files(limit: int = 50, offset: int = 0, sort: str = "created_time", order: str = "desc"):
+    # paginated query on the media index, sort by created_time, size_bytes, duration or path
+    try:
+        total, items = media_index.query("video", sort, order, limit, offset)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return JSONResponse(status_code=200, content={
+        "video_files": [item["path"] for item in items],
+        "items": items,
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+    })
 
 @app.get("/picture-files")
-async def get_picture_files():
-    picture_dir = os.path.join(os.path.expanduser("~"), "picasso", "pictures")
-    if not os.path.exists(picture_dir):
-        return JSONResponse(status_code=404, content={"error": "No pictures found"})
-    
-    picture_files = []
-    # recursively find all .jpg files in the picture directory
-    for root, dirs, files in os.walk(picture_dir):
-        for file in files:
-            if file.endswith('.jpg'):
-                picture_files.append(os.path.join(root, file))
-    # remove thumbnails from the list
-    picture_files = [file for file in picture_files if not file.endswith('_thumbnail.jpg')]
-    return JSONResponse(status_code=200, content={"picture_files": picture_files})
+async def get_picture_files(limit: int = 50, offset: int = 0, sort: str = "created_time", order: str = "desc"):
+    try:
+        total, items = media_index.query("picture", sort, order, limit, offset)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return JSONResponse(status_code=200, content={
+        "picture_files": [item["path"] for item in items],
+        "items": items,
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+    })
+
+@app.get("/reindex")
+async def reindex():
+    # picks up files copied onto the drive by hand
+    result = await asyncio.to_thread(media_index.reconcile)
+    return JSONResponse(status_code=200, content=result)
 
 @app.get("/update-fps")
 async def update_fps(new_fps: int):
@@ -335,6 +394,8 @@ async def take_picture():
     
     picture_path = getNextPicturePath()
     cv2.imwrite(picture_path, frame)
+    await asyncio.to_thread(media_index.add, picture_path, "picture")
+    thumbnails.schedule(picture_path, "picture")
     
     # If recording, use frame rate stabilization for the video
     if recording and video_writer is not None:
@@ -348,8 +409,13 @@ async def take_picture():
 async def download_video(path: str):
     if not path or not os.path.exists(path):
         return JSONResponse(status_code=404, content={"error": "Video file not found"})
+    if os.path.isdir(path):
+        # segmented take, comes down as one tar of its segments and manifest
+        return await export(paths=[path], format="tar")
     
-    return FileResponse(path, media_type='video/avi', filename=os.path.basename(path))
+    media_type = VIDEO_MEDIA_TYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+    # FileResponse answers Range and If-Range, an interrupted download resumes where it stopped
+    return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
 
 @app.get("/download-picture")
 async def download_picture(path: str):
@@ -358,16 +424,43 @@ async def download_picture(path: str):
     
     return FileResponse(path, media_type='image/jpeg', filename=os.path.basename(path))
 
+# ?paths=a&paths=b&format=tar
+@app.get("/export")
+async def export(paths: list[str] = fastapi.Query(...), format: str = "tar"):
+    # several takes and pictures as one uncompressed archive, built while it is sent
+    if format not in ("tar", "zip"):
+        return JSONResponse(status_code=400, content={"error": "format must be tar or zip"})
+    try:
+        entries = await asyncio.to_thread(export_entries, paths, media_index.root)
+    except ValueError as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
+    filename = f"picasso_export_{time.strftime('%Y%m%d_%H%M%S')}.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if format == "tar":
+        # exact size known up front, so the browser can show progress
+        headers["Content-Length"] = str(tar_size(entries))
+        return StreamingResponse(iter_tar(entries), media_type="application/x-tar", headers=headers)
+    return StreamingResponse(iter_zip(entries), media_type="application/zip", headers=headers)
+
 @app.get("/delete-video")
 async def delete_video(path: str):
     if not path or not os.path.exists(path):
         return JSONResponse(status_code=404, content={"error": "Video file not found"})
     
-    os.remove(path)
-    # remove thumbnail if it exists
-    thumbnail_path = path.replace('.avi', '_thumbnail.jpg')
+    thumbnails.discard(path)
+    if os.path.isdir(path):
+        # segmented take, the folder holds its segments and manifest
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    media_index.remove(path)
+    # thumbnails from before the cache sat next to the video
+    thumbnail_path = os.path.splitext(path)[0] + '_thumbnail.jpg'
     if os.path.exists(thumbnail_path):
         os.remove(thumbnail_path)
+    for suffix in PLAYBACK_CACHE_SUFFIXES:
+        if os.path.exists(playback_cache_path(path, suffix)):
+            os.remove(playback_cache_path(path, suffix))
     return JSONResponse(status_code=200, content={"message": "Video deleted successfully"})
 
 @app.get("/delete-picture")
@@ -375,8 +468,10 @@ async def delete_picture(path: str):
     if not path or not os.path.exists(path):
         return JSONResponse(status_code=404, content={"error": "Picture file not found"})
     
+    thumbnails.discard(path)
     os.remove(path)
-    # remove thumbnail if it exists
+    media_index.remove(path)
+    # thumbnails from before the cache sat next to the picture
     thumbnail_path = path.replace('.jpg', '_thumbnail.jpg')
     if os.path.exists(thumbnail_path):
         os.remove(thumbnail_path)
@@ -0,0 +1,269 @@
+import atexit
+import multiprocessing
+import os
+import select
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+from picasso_sources import open_source
+
+# header is a row of int64s in front of the slots
+HEADER_FIELDS = 16
+LATEST_SEQ = 0
+WRITER_PID = 1
+SLOT_COUNT = 2
+CAPTURE_WIDTH = 3
+CAPTURE_HEIGHT = 4
+CAPTURE_FPS_MILLI = 5
+CAPTURE_FOURCC = 6
+FAILED_READS = 7
+SHAPE = 8 # height, width, channels
+FAILED_READS_TOTAL = 11
+CAMERA_REOPENS = 12
+
+class SharedFrameRing:
+    """
+    FrameRing in multiprocessing.shared_memory, so the capture can run in its own process
+    and anything else (the API, other uvicorn workers) maps the same frames without copying
+    them. One writer fills the slot after the newest one: it marks the slot's sequence
+    number -1, reads the camera straight into it, then publishes the new sequence number.
+    A reader holding the latest frame has (slots - 1) frame periods before that slot comes
+    round again. Readers get read-only views
+    """
+    def __init__(self, name, shape=None, slots=8, create=False, writable=False):
+        if create:
+            frame_bytes = int(np.prod(shape))
+            size = (HEADER_FIELDS + 2 * slots) * 8 + slots * frame_bytes
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        # before python 3.13 every process that opens the block registers it and it gets
+        # unlinked when any of them exits, CaptureProcess unlinks it itself instead
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+        self.name = name
+        buf = self._shm.buf
+        self._header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=buf)
+        if create:
+            self._header[:] = 0
+            self._header[SLOT_COUNT] = slots
+            # the shape lives in the header so attaching only needs the name
+            self._header[SHAPE:SHAPE + 3] = shape
+        self.slots = int(self._header[SLOT_COUNT])
+        self.shape = tuple(int(v) for v in self._header[SHAPE:SHAPE + 3])
+        self._slot_seqs = np.ndarray((self.slots,), dtype=np.int64, buffer=buf, offset=HEADER_FIELDS * 8)
+        # time.monotonic() each slot's frame was read at, the same clock in every process
+        self._slot_times = np.ndarray((self.slots,), dtype=np.float64, buffer=buf, offset=(HEADER_FIELDS + self.slots) * 8)
+        if create:
+            self._slot_seqs[:] = -1
+        self._frames = np.ndarray((self.slots, *self.shape), dtype=np.uint8, buffer=buf, offset=(HEADER_FIELDS + 2 * self.slots) * 8)
+        if not writable:
+            self._frames.flags.writeable = False
+
+    @property
+    def latest_seq(self):
+        return int(self._header[LATEST_SEQ])
+
+    def frame(self, seq):
+        # the frame published as seq, None once the writer has gone past it
+        index = seq % self.slots
+        if seq <= 0 or self._slot_seqs[index] != seq:
+            return None
+        return self._frames[index]
+
+    def capture_time(self, seq):
+        # read once the frame is in hand, None if the slot moved on meanwhile
+        index = seq % self.slots
+        capture_time = float(self._slot_times[index])
+        if self._slot_seqs[index] != seq:
+            return None
+        return capture_time
+
+    def begin_write(self):
+        # writer only, the slot the next frame goes into
+        index = (self.latest_seq + 1) % self.slots
+        self._slot_seqs[index] = -1
+        return self._frames[index]
+
+    def commit(self, capture_time=0.0):
+        seq = self.latest_seq + 1
+        self._slot_times[seq % self.slots] = capture_time
+        self._slot_seqs[seq % self.slots] = seq
+        self._header[LATEST_SEQ] = seq
+        return seq
+
+    def set_header(self, field, value):
+        self._header[field] = value
+
+    def get_header(self, field):
+        return int(self._header[field])
+
+    def capture_format(self):
+        # what the camera process actually got from the driver, None until it opened it
+        if self.get_header(CAPTURE_WIDTH) == 0:
+            return None
+        fourcc = self.get_header(CAPTURE_FOURCC)
+        return {
+            "width": self.get_header(CAPTURE_WIDTH),
+            "height": self.get_header(CAPTURE_HEIGHT),
+            "fps": self.get_header(CAPTURE_FPS_MILLI) / 1000,
+            "fourcc": "".join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip("\x00"),
+        }
+
+    def writer_alive(self):
+        pid = self.get_header(WRITER_PID)
+        if pid <= 0:
+            return False
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True # alive, just not ours
+
+    def close(self):
+        self._header = self._slot_seqs = self._slot_times = self._frames = None
+        self._shm.close()
+
+    def unlink(self):
+        # SharedMemory.unlink unregisters it again, it was already unregistered when opened
+        resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+
+def open_capture(device, width, height, fps, ring):
+    cap = open_source(device)
+    cap.set(cv2.CAP_PROP_FPS, fps)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    ring.set_header(CAPTURE_WIDTH, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)))
+    ring.set_header(CAPTURE_HEIGHT, int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    ring.set_header(CAPTURE_FPS_MILLI, int(cap.get(cv2.CAP_PROP_FPS) * 1000))
+    ring.set_header(CAPTURE_FOURCC, int(cap.get(cv2.CAP_PROP_FOURCC)))
+    return cap
+
+def run_capture_process(ring_name, device, fps, wake_connection):
+    """
+    Body of the capture process. Only reads the camera into the ring and pokes
+    wake_connection once per frame, everything else happens in the API process. Reopens
+    the camera after 10 failed reads in a row (unplugged)
+    """
+    ring = SharedFrameRing(ring_name, writable=True)
+    height, width = ring.shape[:2]
+    ring.set_header(WRITER_PID, os.getpid())
+    # raw single bytes on the connection's fd, a full pipe must never block the camera
+    wake_fd = wake_connection.fileno()
+    os.set_blocking(wake_fd, False)
+    cap = open_capture(device, width, height, fps, ring)
+    failed_reads = 0
+    while True:
+        slot = ring.begin_write()
+        ret, frame = cap.read(slot)
+        capture_time = time.monotonic()
+        if not ret or frame is None:
+            failed_reads += 1
+            ring.set_header(FAILED_READS, failed_reads)
+            ring.set_header(FAILED_READS_TOTAL, ring.get_header(FAILED_READS_TOTAL) + 1)
+            if failed_reads >= 10:
+                cap.release()
+                time.sleep(2)
+                cap = open_capture(device, width, height, fps, ring)
+                ring.set_header(CAMERA_REOPENS, ring.get_header(CAMERA_REOPENS) + 1)
+                failed_reads = 0
+            continue
+        if frame is not slot:
+            # the camera did not give us the configured size, the ring only holds that one
+            cv2.resize(frame, (width, height), dst=slot)
+        failed_reads = 0
+        ring.set_header(FAILED_READS, 0)
+        ring.commit(capture_time)
+        try:
+            os.write(wake_fd, b"\0")
+        except BlockingIOError:
+            pass # reader is behind, it has wakeups queued already
+        except BrokenPipeError:
+            return # the server is gone
+
+class CaptureProcess:
+    """
+    Runs one camera's capture in its own process (spawned, so it does not inherit the
+    server's threads) writing into a SharedFrameRing named after the camera. If a live
+    ring of that name already exists, another process (like a second uvicorn worker) owns
+    the camera and this one only attaches to the frames
+    """
+    def __init__(self, camera_id, device, shape, fps, slots=8):
+        self.device = device
+        self.fps = fps
+        self.name = f"picasso_frames_{camera_id}"
+        self.owner = True
+        try:
+            self.ring = SharedFrameRing(self.name, shape, slots, create=True)
+        except FileExistsError:
+            ring = SharedFrameRing(self.name)
+            if ring.writer_alive() and ring.shape == tuple(shape):
+                self.ring = ring
+                self.owner = False
+            else:
+                # left behind by a crashed run
+                ring.close()
+                ring.unlink()
+                self.ring = SharedFrameRing(self.name, shape, slots, create=True)
+        if self.owner:
+            atexit.register(self.close)
+        self._context = multiprocessing.get_context("spawn")
+        self._wake_reader, self._wake_writer = self._context.Pipe(duplex=False)
+        self._proc = None
+        self._last_seq = self.ring.latest_seq
+
+    def start(self):
+        if not self.owner:
+            return
+        # the connection is how the pipe's fd gets into a spawned process
+        self._proc = self._context.Process(
+            target=run_capture_process,
+            args=(self.name, self.device, self.fps, self._wake_writer),
+            name=f"capture {self.name}",
+            daemon=True
+        )
+        self._proc.start()
+
+    def alive(self):
+        if not self.owner:
+            return self.ring.writer_alive()
+        return self._proc is not None and self._proc.is_alive()
+
+    def restart(self):
+        if self._proc is not None and self._proc.is_alive():
+            self._proc.kill()
+        self.start()
+
+    def wait(self, timeout=1.0):
+        """
+        Blocks until the ring has a frame newer than the last one returned, returns its
+        sequence number or None on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            seq = self.ring.latest_seq
+            if seq != self._last_seq:
+                self._last_seq = seq
+                return seq
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if self.owner:
+                # one byte per frame from the capture process, drained all at once
+                if select.select([self._wake_reader.fileno()], [], [], remaining)[0]:
+                    os.read(self._wake_reader.fileno(), 4096)
+            else:
+                # no pipe to another process' capture, poll at a fraction of the frame time
+                time.sleep(min(remaining, 0.25 / max(self.fps, 1)))
+
+    def close(self):
+        if self._proc is not None and self._proc.is_alive():
+            self._proc.kill()
+            self._proc.join()
+        if self.owner:
+            self.ring.unlink()
@@ -0,0 +1,705 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+VIDEO_EXTENSIONS = (".avi", ".mkv", ".mp4") # avi from before takes were mkv or fragmented mp4
+VIDEO_MEDIA_TYPES = {".avi": "video/avi", ".mkv": "video/x-matroska", ".mp4": "video/mp4"}
+PICTURE_EXTENSIONS = (".jpg",)
+SORT_COLUMNS = ("created_time", "size_bytes", "duration", "path")
+THUMBNAIL_SIZE = 320 # longest side in pixels
+EXPORT_CHUNK_SIZE = 1024 * 1024
+PLAYBACK_CODECS = ("h264",) # browsers play these from mp4 as they are, anything else is transcoded
+PLAYBACK_CACHE_SUFFIXES = ("playback.json", "sprite.jpg")
+SPRITE_TILE_WIDTH = 160
+SPRITE_COLUMNS = 10
+SPRITE_MAX_TILES = 100
+
+def media_stat(path):
+    # (size, mtime), a take folder counts as the sum of its segments
+    if os.path.isdir(path):
+        size = 0
+        mtime = os.path.getmtime(path)
+        for name in os.listdir(path):
+            file_path = os.path.join(path, name)
+            size += os.path.getsize(file_path)
+            mtime = max(mtime, os.path.getmtime(file_path))
+        return size, mtime
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+# segments of a segmented take, part_00000.mkv and so on
+SEGMENT_NAME_PATTERN = re.compile(r"^part_\d+\.(mkv|mp4)$")
+# picasso/videos/MonthFullNameYYYY/DD__HH_MM_SS_PM[__camera][_n].mkv, pictures the same
+MEDIA_NAME_PATTERN = re.compile(r"^(\d{2})__(\d{2}_\d{2}_\d{2}_[AP]M)")
+
+def media_created_time(path):
+    """
+    When a take or picture was started, as a timestamp. mtime is not it: the faststart
+    remux and the copy to USB both rewrite the file. A take's manifest has its start time,
+    otherwise it is in the name picasso gave the file, and a file named by hand falls back
+    to its birth time (ctime where the filesystem has none)
+    """
+    if os.path.isdir(path):
+        try:
+            with open(os.path.join(path, "manifest.json"), "r") as f:
+                return datetime.datetime.fromisoformat(json.load(f)["start_time"]).timestamp()
+        except (OSError, ValueError, KeyError):
+            pass
+    match = MEDIA_NAME_PATTERN.match(os.path.basename(path))
+    if match:
+        try:
+            month = os.path.basename(os.path.dirname(path))
+            return datetime.datetime.strptime(f"{month} {match.group(1)} {match.group(2)}", "%B%Y %d %I_%M_%S_%p").timestamp()
+        except ValueError:
+            pass
+    stat = os.stat(path)
+    return getattr(stat, "st_birthtime", stat.st_ctime)
+
+def probe_picture(path):
+    """
+    Reads a JPEG's size from its SOF marker instead of decoding the whole image
+    """
+    with open(path, "rb") as f:
+        data = f.read(64 * 1024)
+    offset = 2
+    while offset + 9 < len(data):
+        if data[offset] != 0xFF:
+            break
+        marker = data[offset + 1]
+        length = int.from_bytes(data[offset + 2:offset + 4], "big")
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC) which share the range
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[offset + 5:offset + 7], "big")
+            width = int.from_bytes(data[offset + 7:offset + 9], "big")
+            return {"width": width, "height": height, "codec": "jpeg", "duration": None}
+        offset += 2 + length
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_8)
+    if img is None:
+        return {"width": None, "height": None, "codec": "jpeg", "duration": None}
+    # reduced decode is 1/8 of the size
+    return {"width": img.shape[1] * 8, "height": img.shape[0] * 8, "codec": "jpeg", "duration": None}
+
+def probe_video(path):
+    try:
+        output = subprocess.run([
+            "ffprobe", "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name,width,height:format=duration",
+            "-of", "json",
+            path
+        ], capture_output=True, text=True, timeout=30).stdout
+        info = json.loads(output or "{}")
+        stream = (info.get("streams") or [{}])[0]
+        duration = info.get("format", {}).get("duration")
+        return {
+            "width": stream.get("width"),
+            "height": stream.get("height"),
+            "codec": stream.get("codec_name"),
+            "duration": float(duration) if duration not in (None, "N/A") else None,
+        }
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        # no ffprobe, opencv can still tell most of it
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            return {"width": None, "height": None, "codec": None, "duration": None}
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        info = {
+            "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "codec": "".join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip("\x00") or None,
+            "duration": frames / fps if fps > 0 else None,
+        }
+        cap.release()
+        return info
+
+def is_take_dir(files):
+    # a segmented take's folder, finished (manifest) or cut short before it got one
+    return "manifest.json" in files or any(SEGMENT_NAME_PATTERN.match(file) for file in files)
+
+def take_segments(take_dir):
+    """
+    [{"file", "start", "end"}] of a segmented take. The manifest has them, a take that
+    never got one (power cut while recording) has its parts probed one by one instead
+    """
+    try:
+        with open(os.path.join(take_dir, "manifest.json"), "r") as f:
+            return [{"file": segment["file"], "start": segment["start"], "end": segment["end"]} for segment in json.load(f).get("segments", [])]
+    except FileNotFoundError:
+        pass
+    segments = []
+    start = 0.0
+    for file in sorted(file for file in os.listdir(take_dir) if SEGMENT_NAME_PATTERN.match(file)):
+        end = start + (probe_video(os.path.join(take_dir, file))["duration"] or 0.0)
+        segments.append({"file": file, "start": start, "end": end})
+        start = end
+    return segments
+
+def probe_take(take_dir):
+    # segmented takes are a folder of segments, indexed as one video
+    segments = take_segments(take_dir)
+    info = probe_video(os.path.join(take_dir, segments[0]["file"])) if segments else {"width": None, "height": None, "codec": None}
+    info["duration"] = segments[-1]["end"] if segments else 0
+    return info
+
+class MediaIndex:
+    """
+    SQLite index of every video and picture under a picasso root (root/library.db), so
+    listing the library is a query instead of walking the whole drive. Entries are added
+    or removed as files are written and deleted, and reconcile() catches up with anything
+    that changed while nobody was watching by comparing size and mtime
+    """
+    def __init__(self, root):
+        self.root = root
+        self.db_path = os.path.join(root, "library.db")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock:
+            # wal so picasso_api.py and picasso2.py can both use it
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS media (
+                    path TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    created_time REAL NOT NULL,
+                    duration REAL,
+                    width INTEGER,
+                    height INTEGER,
+                    codec TEXT
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS media_kind_created ON media (kind, created_time)")
+            self._db.commit()
+
+    def add(self, path, kind):
+        if not os.path.exists(path):
+            return
+        size, mtime = media_stat(path)
+        if kind == "picture":
+            info = probe_picture(path)
+        elif os.path.isdir(path):
+            info = probe_take(path)
+        else:
+            info = probe_video(path)
+        with self._lock:
+            self._db.execute("""
+                INSERT OR REPLACE INTO media (path, kind, size_bytes, mtime, created_time, duration, width, height, codec)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (path, kind, size, mtime, media_created_time(path), info["duration"], info["width"], info["height"], info["codec"]))
+            self._db.commit()
+
+    def remove(self, path):
+        with self._lock:
+            self._db.execute("DELETE FROM media WHERE path = ?", (path,))
+            self._db.commit()
+
+    def _scan(self):
+        # what is on disk right now, {path: kind}
+        found = {}
+        for root, dirs, files in os.walk(os.path.join(self.root, "videos")):
+            if is_take_dir(files):
+                found[root] = "video"
+                dirs[:] = []
+                continue
+            for file in files:
+                if file.endswith(VIDEO_EXTENSIONS):
+                    found[os.path.join(root, file)] = "video"
+        for root, dirs, files in os.walk(os.path.join(self.root, "pictures")):
+            for file in files:
+                if file.endswith(PICTURE_EXTENSIONS) and not file.endswith("_thumbnail.jpg"):
+                    found[os.path.join(root, file)] = "picture"
+        return found
+
+    def reconcile(self):
+        """
+        Brings the index in line with the disk. Only files that are new or whose size or
+        mtime changed get probed again, so this is mostly stat calls
+        """
+        found = self._scan()
+        with self._lock:
+            known = {row["path"]: (row["size_bytes"], row["mtime"]) for row in self._db.execute("SELECT path, size_bytes, mtime FROM media")}
+        for path in known.keys() - found.keys():
+            self.remove(path)
+        added = 0
+        for path, kind in found.items():
+            try:
+                if known.get(path) != media_stat(path):
+                    self.add(path, kind)
+                    added += 1
+            except OSError:
+                pass # deleted while we were scanning
+        return {"added": added, "removed": len(known.keys() - found.keys()), "total": len(found)}
+
+    def paths(self):
+        with self._lock:
+            return [row["path"] for row in self._db.execute("SELECT path FROM media")]
+
+    def query(self, kind, sort="created_time", order="desc", limit=50, offset=0):
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_COLUMNS)}")
+        order = "ASC" if order.lower() == "asc" else "DESC"
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM media WHERE kind = ?", (kind,)).fetchone()[0]
+            rows = self._db.execute(
+                f"SELECT * FROM media WHERE kind = ? ORDER BY {sort} {order}, path LIMIT ? OFFSET ?",
+                (kind, limit, offset)
+            ).fetchall()
+        return total, [dict(row) for row in rows]
+
+def fit_size(width, height, max_size):
+    # keeps the aspect ratio, never upscales
+    scale = min(1.0, max_size / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def read_video_frame(path, at_seconds=1.0):
+    if os.path.isdir(path):
+        # segmented take, the first segment has the start of it
+        segments = sorted(name for name in os.listdir(path) if name.endswith(VIDEO_EXTENSIONS))
+        if not segments:
+            return None
+        path = os.path.join(path, segments[0])
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        return None
+    cap.set(cv2.CAP_PROP_POS_MSEC, at_seconds * 1000)
+    ret, frame = cap.read()
+    if not ret:
+        # shorter than at_seconds, the first frame will do
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        ret, frame = cap.read()
+    cap.release()
+    return frame if ret else None
+
+class ThumbnailCache:
+    """
+    Thumbnails for the library in root/thumbnails, named after a hash of the source's
+    path, mtime and size. A file that changes gets a new name, so a cached thumbnail is
+    never stale and its name doubles as the ETag. Generated once in the background when a
+    video or picture is saved, or on the first request for files that were not
+    """
+    def __init__(self, root, max_size=THUMBNAIL_SIZE):
+        self.dir = os.path.join(root, "thumbnails")
+        self.max_size = max_size
+        os.makedirs(self.dir, exist_ok=True)
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnails")
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def key(self, path):
+        size, mtime = media_stat(path)
+        return hashlib.sha1(f"{path}\0{mtime}\0{size}\0{self.max_size}".encode()).hexdigest()[:24]
+
+    def path_for(self, key):
+        return os.path.join(self.dir, f"{key}.jpg")
+
+    def _render(self, path, kind):
+        if kind == "picture":
+            # the jpeg decoder scales by 1/4 while decoding, far less work than a full decode
+            img = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_4)
+            if img is not None and max(img.shape[:2]) < self.max_size:
+                img = cv2.imread(path)
+        else:
+            img = read_video_frame(path)
+        if img is None:
+            return None
+        width, height = fit_size(img.shape[1], img.shape[0], self.max_size)
+        if (width, height) != (img.shape[1], img.shape[0]):
+            img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        return buffer.tobytes() if ok else None
+
+    def get(self, path, kind):
+        """
+        Returns (key, thumbnail_path), making the thumbnail first if it is not cached.
+        thumbnail_path is None if the source could not be decoded
+        """
+        key = self.key(path)
+        thumbnail_path = self.path_for(key)
+        if os.path.exists(thumbnail_path):
+            return key, thumbnail_path
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # a request and the background job can ask for the same one at once
+        with lock:
+            try:
+                if not os.path.exists(thumbnail_path):
+                    data = self._render(path, kind)
+                    if data is None:
+                        return key, None
+                    tmp_path = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp_path, thumbnail_path)
+            finally:
+                with self._locks_lock:
+                    self._locks.pop(key, None)
+        return key, thumbnail_path
+
+    def _generate(self, path, kind):
+        try:
+            self.get(path, kind)
+        except Exception as e:
+            print(f"Failed to make thumbnail for {path}: {e}")
+
+    def schedule(self, path, kind):
+        self._pool.submit(self._generate, path, kind)
+
+    def discard(self, path):
+        # call before deleting the source, the key needs its stat
+        try:
+            thumbnail_path = self.path_for(self.key(path))
+        except OSError:
+            return
+        if os.path.exists(thumbnail_path):
+            os.remove(thumbnail_path)
+
+    def prune(self, paths):
+        """
+        Removes thumbnails that do not belong to the current version of any of paths,
+        left behind by files that were deleted or changed behind our back
+        """
+        keep = set()
+        for path in paths:
+            try:
+                keep.add(f"{self.key(path)}.jpg")
+            except OSError:
+                pass
+        removed = 0
+        for name in os.listdir(self.dir):
+            if name.endswith(".jpg") and name not in keep:
+                os.remove(os.path.join(self.dir, name))
+                removed += 1
+        return removed
+
+def export_entries(paths, root):
+    """
+    Expands paths (files or segmented take folders) into (arcname, path, size) for
+    iter_tar/iter_zip, with arcnames relative to root so the library layout is kept.
+    Raises ValueError for anything outside root or missing
+    """
+    root = os.path.realpath(root)
+    entries = []
+    for path in paths:
+        real_path = os.path.realpath(path)
+        if os.path.commonpath([root, real_path]) != root or not os.path.exists(real_path):
+            raise ValueError(f"Not in the library: {path}")
+        if os.path.isdir(real_path):
+            files = sorted(os.path.join(dir_path, name) for dir_path, _, names in os.walk(real_path) for name in names)
+        else:
+            files = [real_path]
+        for file_path in files:
+            entries.append((os.path.relpath(file_path, root), file_path, os.path.getsize(file_path)))
+    return entries
+
+def _tar_header(arcname, path, size):
+    info = tarfile.TarInfo(arcname)
+    info.size = size
+    info.mtime = int(os.path.getmtime(path))
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+def tar_size(entries):
+    # exact length of what iter_tar yields, so the download can send a Content-Length
+    total = 1024 # two empty blocks end the archive
+    for arcname, path, size in entries:
+        total += len(_tar_header(arcname, path, size)) + size + (-size % tarfile.BLOCKSIZE)
+    return total
+
+def iter_tar(entries):
+    """
+    Uncompressed tar of entries, built as it is sent so nothing is staged on disk.
+    Footage is already compressed, gzip would only cost cpu
+    """
+    for arcname, path, size in entries:
+        yield _tar_header(arcname, path, size)
+        remaining = size
+        with open(path, "rb") as f:
+            # never more than the header promised, a file still growing would break the archive
+            while remaining > 0:
+                chunk = f.read(min(EXPORT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        if remaining:
+            # shrank while we read it, pad so the archive stays readable
+            yield bytes(remaining)
+        yield bytes(-size % tarfile.BLOCKSIZE)
+    yield bytes(1024)
+
+class _ChunkSink:
+    # write-only file for zipfile, collects what it writes until the generator yields it
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_zip(entries):
+    """
+    Stored (uncompressed) zip of entries, built as it is sent. zipfile falls back to data
+    descriptors since the sink can't seek, so each file is read exactly once
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for arcname, path, size in entries:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            with open(path, "rb") as f, archive.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as out:
+                while chunk := f.read(EXPORT_CHUNK_SIZE):
+                    out.write(chunk)
+                    if data := sink.take():
+                        yield data
+            if data := sink.take():
+                yield data
+    # the central directory is written on close
+    if data := sink.take():
+        yield data
+
+def playback_cache_path(path, suffix):
+    # next to the video (or take folder), a file inside a take would change its size and mtime
+    return f"{os.path.splitext(path.rstrip(os.sep))[0]}.{suffix}"
+
+def is_faststart_mp4(path):
+    """
+    True for an mp4 with its moov index ahead of the media data, which is what a browser
+    can play straight from the file and seek with Range requests. mkv, an mp4 with the
+    index at the end and a fragmented mp4 (moof before the first mdat) are not
+    """
+    if not path.endswith(".mp4"):
+        return False
+    moov = False
+    try:
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size = int.from_bytes(header[:4], "big")
+                box_type = header[4:]
+                if box_type == b"moov":
+                    moov = True # a fragmented mp4 starts with one too, keep going
+                elif box_type == b"mdat":
+                    return moov
+                elif box_type == b"moof":
+                    return False
+                if size == 1:
+                    size = int.from_bytes(f.read(8), "big") - 8
+                if size < 8:
+                    return False
+                f.seek(size - 8, os.SEEK_CUR)
+    except OSError:
+        return False
+
+def probe_keyframes(path):
+    """
+    [(seconds, byte offset)] of every keyframe, from the packet headers alone so nothing
+    gets decoded. Empty if ffprobe is missing
+    """
+    try:
+        output = subprocess.run([
+            "ffprobe", "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "packet=pts_time,dts_time,pos,flags",
+            "-of", "json",
+            path
+        ], capture_output=True, text=True, timeout=600).stdout
+        packets = json.loads(output or "{}").get("packets", [])
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        return []
+    keyframes = []
+    for packet in packets:
+        if "K" not in packet.get("flags", ""):
+            continue
+        # avi has no pts
+        time = packet.get("pts_time", "N/A")
+        if time == "N/A":
+            time = packet.get("dts_time", "N/A")
+        if time == "N/A":
+            continue
+        pos = packet.get("pos", "N/A")
+        keyframes.append((float(time), int(pos) if pos != "N/A" else None))
+    return keyframes
+
+def load_playback_index(path):
+    """
+    Keyframe index of a video or segmented take, built once and cached in
+    <name>.playback.json. Keyframe times are on the take's timeline, pos is the byte
+    offset in that keyframe's segment so a player can seek with a Range request
+    """
+    cache_path = playback_cache_path(path, "playback.json")
+    size, mtime = media_stat(path)
+    try:
+        with open(cache_path, "r") as f:
+            index = json.load(f)
+        if index["source"] == [size, mtime]:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    if os.path.isdir(path):
+        segments = take_segments(path)
+        info = probe_video(os.path.join(path, segments[0]["file"])) if segments else {"codec": None, "width": None, "height": None}
+    else:
+        info = probe_video(path)
+        segments = [{"file": os.path.basename(path), "start": 0.0, "end": info["duration"] or 0.0}]
+    base_dir = path if os.path.isdir(path) else os.path.dirname(path)
+    keyframes = []
+    for i, segment in enumerate(segments):
+        for time, pos in probe_keyframes(os.path.join(base_dir, segment["file"])):
+            keyframes.append({"time": segment["start"] + time, "pos": pos, "segment": i})
+    index = {
+        "source": [size, mtime],
+        "codec": info["codec"],
+        "width": info["width"],
+        "height": info["height"],
+        "duration": segments[-1]["end"] if segments else 0.0,
+        "faststart": not os.path.isdir(path) and is_faststart_mp4(path),
+        "segments": segments,
+        "keyframes": keyframes,
+        "sprite": None,
+    }
+    _write_playback_index(cache_path, index)
+    return index
+
+def _write_playback_index(cache_path, index):
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, cache_path)
+
+def find_segment(index, seconds):
+    # (segment number, segment) that plays at seconds, the last one past the end
+    for i, segment in enumerate(index["segments"]):
+        if seconds < segment["end"]:
+            return i, segment
+    return len(index["segments"]) - 1, index["segments"][-1]
+
+def keyframe_before(index, seconds):
+    """
+    Take time of the last keyframe at or before seconds in the same segment, where a
+    stream copy can start. Without keyframes for the segment (no ffprobe) seconds is
+    returned as is and the decoder does its own seeking
+    """
+    segment_number, segment = find_segment(index, seconds)
+    keyframes = [keyframe["time"] for keyframe in index["keyframes"] if keyframe["segment"] == segment_number]
+    if not keyframes:
+        return max(seconds, segment["start"])
+    return max([time for time in keyframes if time <= seconds], default=segment["start"])
+
+def playback_command(path, index, start, duration):
+    """
+    ffmpeg args streaming duration seconds of the take from the keyframe before start as
+    fragmented mp4 on stdout, and the take time it really starts at. Never crosses a
+    segment, the player asks for the next one. Timestamps are on the take's timeline so
+    fragments can be appended to one MSE buffer
+    """
+    start = keyframe_before(index, start)
+    _, segment = find_segment(index, start)
+    source = os.path.join(path, segment["file"]) if os.path.isdir(path) else path
+    duration = max(0.1, min(duration, segment["end"] - start)) if segment["end"] else duration
+    if index["codec"] in PLAYBACK_CODECS:
+        video_args = ["-c:v", "copy"]
+    else:
+        video_args = ["-c:v", "libx264", "-preset", "ultrafast", "-crf", "26", "-pix_fmt", "yuv420p"]
+    return [
+        "ffmpeg", "-v", "error",
+        "-ss", f"{start - segment['start']:.3f}",
+        "-i", source,
+        "-t", f"{duration:.3f}",
+        "-map", "0:v:0", "-an",
+        *video_args,
+        "-output_ts_offset", f"{start:.3f}",
+        "-f", "mp4",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "pipe:1"
+    ], start
+
+def load_sprite(path, interval=10):
+    """
+    Scrub bar sprite sheet, one tile every interval seconds (more if the take would need
+    over SPRITE_MAX_TILES) in rows of SPRITE_COLUMNS, cached in <name>.sprite.jpg.
+    Each tile is seeked to its nearest keyframe so only that one frame is decoded.
+    Returns (sprite_path, info) or (None, None) if nothing could be decoded
+    """
+    index = load_playback_index(path)
+    sprite_path = playback_cache_path(path, "sprite.jpg")
+    sprite = index.get("sprite")
+    if sprite and sprite["requested_interval"] == interval and os.path.exists(sprite_path):
+        return sprite_path, sprite
+    step = max(interval, index["duration"] / SPRITE_MAX_TILES)
+    times = [i * step for i in range(max(1, int(-(-index["duration"] // step))))]
+    tiles = []
+    captures = {}
+    try:
+        for time in times:
+            segment_number, segment = find_segment(index, time)
+            if segment_number not in captures:
+                source = os.path.join(path, segment["file"]) if os.path.isdir(path) else path
+                captures[segment_number] = cv2.VideoCapture(source)
+            cap = captures[segment_number]
+            cap.set(cv2.CAP_PROP_POS_MSEC, (keyframe_before(index, time) - segment["start"]) * 1000)
+            ret, frame = cap.read()
+            tiles.append(frame if ret else None)
+    finally:
+        for cap in captures.values():
+            cap.release()
+    first = next((tile for tile in tiles if tile is not None), None)
+    if first is None:
+        return None, None
+    tile_width, tile_height = fit_size(first.shape[1], first.shape[0], SPRITE_TILE_WIDTH)
+    columns = min(SPRITE_COLUMNS, len(tiles))
+    rows = -(-len(tiles) // columns)
+    sheet = np.zeros((rows * tile_height, columns * tile_width, 3), np.uint8)
+    for i, tile in enumerate(tiles):
+        if tile is None:
+            continue
+        y, x = (i // columns) * tile_height, (i % columns) * tile_width
+        cv2.resize(tile, (tile_width, tile_height), dst=sheet[y:y + tile_height, x:x + tile_width], interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode(".jpg", sheet, [cv2.IMWRITE_JPEG_QUALITY, 70])
+    if not ok:
+        return None, None
+    tmp_path = f"{sprite_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buffer.tobytes())
+    os.replace(tmp_path, sprite_path)
+    index["sprite"] = {
+        "requested_interval": interval,
+        "interval": step,
+        "count": len(tiles),
+        "columns": columns,
+        "rows": rows,
+        "tile_width": tile_width,
+        "tile_height": tile_height,
+    }
+    _write_playback_index(playback_cache_path(path, "playback.json"), index)
+    return sprite_path, index["sprite"]
+
+def prepare_playback(path):
+    # builds the index and sprite right after a take is saved, so the first scrub is instant
+    try:
+        load_sprite(path)
+    except Exception as e:
+        print(f"Failed to prepare playback for {path}: {e}")
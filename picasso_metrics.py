@@ -0,0 +1,145 @@
+import bisect
+import math
+
+# seconds, around one frame period at 30 fps where it matters
+FRAME_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.015, 0.02, 0.033, 0.05, 0.1, 0.25, 1.0)
+# seconds, capture to viewer takes a few frame periods
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.033, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Gauge:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        # read when /metrics is scraped instead of kept up to date by the hot path
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one per bucket plus +Inf, cumulated only when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+        return repr(value)
+    return str(int(value))
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(pairs, escaped)) + "}"
+
+class MetricFamily:
+    """
+    One metric name with a child per label set. Children are made once with labels()
+    and kept by whoever updates them, so the frame loops only touch an int or a list
+    slot and never allocate or look anything up. Updates are not locked: every child
+    has a single writer thread except a few counters where a rare lost increment does
+    not matter
+    """
+    def __init__(self, name, help_text, kind, labelnames, buckets=None):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if self.kind == "counter":
+                child = Counter()
+            elif self.kind == "gauge":
+                child = Gauge()
+            else:
+                child = Histogram(self.buckets)
+            self._children[values] = child
+        return child
+
+    def remove(self, *values):
+        # for label sets that go away, like a disconnected client
+        self._children.pop(tuple(str(value) for value in values), None)
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        # copied, a client can connect while we render
+        for values, child in list(self._children.items()):
+            if self.kind == "counter":
+                lines.append(f"{self.name}{format_labels(self.labelnames, values)} {format_value(child.value)}")
+            elif self.kind == "gauge":
+                lines.append(f"{self.name}{format_labels(self.labelnames, values)} {format_value(child.get())}")
+            else:
+                cumulative = 0
+                for bound, count in zip((*child.buckets, math.inf), child.counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, values, ('le', format_value(float(bound))))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, values)} {format_value(float(child.sum))}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, values)} {child.count}")
+
+class MetricsRegistry:
+    """
+    Metric families rendered in the Prometheus text format for /metrics
+    """
+    def __init__(self):
+        self.families = {}
+
+    def _add(self, family):
+        if family.name in self.families:
+            raise ValueError(f"Metric {family.name} is already registered")
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(MetricFamily(name, help_text, "counter", labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._add(MetricFamily(name, help_text, "gauge", labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=FRAME_TIME_BUCKETS):
+        return self._add(MetricFamily(name, help_text, "histogram", labelnames, tuple(sorted(buckets))))
+
+    def render(self):
+        lines = []
+        for family in self.families.values():
+            family.render(lines)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,180 @@
+import time
+
+import cv2
+import numpy as np
+
+# device strings that are not a capture device, see open_source
+SYNTHETIC_PREFIX = "synthetic"
+FILE_PREFIX = "file:"
+
+def is_capture_device(device):
+    return not (device == SYNTHETIC_PREFIX or device.startswith(SYNTHETIC_PREFIX + ":") or device.startswith(FILE_PREFIX))
+
+def open_source(device):
+    """
+    Opens a frame source by its device string, the same way camera_device and cameras[].device
+    are given in the config:
+        /dev/video0                  a camera (anything cv2.VideoCapture opens)
+        synthetic                    moving test pattern at whatever size and fps is set
+        synthetic:1920x1080          the pattern at a fixed size, like a camera that ignores
+                                     the requested resolution, so frames get resized
+        synthetic:unpaced            as fast as it can instead of at the set fps
+        file:/path/to/video.mp4      a video file, looped and paced at the set fps
+    Sources other than cameras answer the cv2.VideoCapture calls picasso makes (read, get,
+    set, isOpened, release), so they drop in wherever a capture is opened
+    """
+    if device.startswith(FILE_PREFIX):
+        return FileSource(device[len(FILE_PREFIX):])
+    if not is_capture_device(device):
+        options = device.split(":")[1:]
+        size = next((option for option in options if "x" in option), None)
+        return SyntheticSource(
+            size=tuple(int(v) for v in size.split("x")) if size else None,
+            paced="unpaced" not in options
+        )
+    return cv2.VideoCapture(device)
+
+class FramePacer:
+    # sleeps until the next frame is due, skips ahead instead of bursting after a stall
+    def __init__(self, fps):
+        self.fps = fps
+        self._next = None
+
+    def wait(self):
+        now = time.monotonic()
+        if self._next is None or now - self._next > 1 / self.fps:
+            self._next = now
+        elif self._next > now:
+            time.sleep(self._next - now)
+        self._next += 1 / self.fps
+
+class SyntheticSource:
+    """
+    Moving test pattern: a diagonal gradient with bars scrolling across it and the frame
+    number printed on top. The pattern is rendered once at twice the width and every frame
+    is a window into it copied into the caller's buffer, about what a camera driver costs
+    """
+    def __init__(self, size=None, paced=True):
+        self.fixed_size = size
+        self.width, self.height = size or (640, 480)
+        self.fps = 30.0
+        self.paced = paced
+        self.frames = 0
+        self._pacer = FramePacer(self.fps)
+        self._pattern = None
+
+    def _render_pattern(self):
+        y, x = np.mgrid[0:self.height, 0:self.width * 2]
+        pattern = np.empty((self.height, self.width * 2, 3), dtype=np.uint8)
+        pattern[..., 0] = (x * 255 // (self.width * 2)).astype(np.uint8)
+        pattern[..., 1] = (y * 255 // max(self.height - 1, 1)).astype(np.uint8)
+        pattern[..., 2] = ((x + y) // 8 % 2 * 160).astype(np.uint8)
+        # bars are what make motion visible in a preview
+        bar = max(self.width // 16, 1)
+        for left in range(0, self.width * 2, bar * 4):
+            pattern[:, left:left + bar] = 255 - pattern[:, left:left + bar]
+        self._pattern = pattern
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        self._pattern = None
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FPS and value > 0:
+            self.fps = float(value)
+            self._pacer = FramePacer(self.fps)
+            return True
+        if self.fixed_size is None and prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.width = int(value)
+            self._pattern = None
+            return True
+        if self.fixed_size is None and prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.height = int(value)
+            self._pattern = None
+            return True
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FOURCC:
+            return float(cv2.VideoWriter_fourcc(*"BGR3"))
+        return 0.0
+
+    def read(self, image=None):
+        if self._pattern is None:
+            self._render_pattern()
+        if self.paced:
+            self._pacer.wait()
+        if image is None or image.shape != (self.height, self.width, 3):
+            image = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        # one pixel column per frame at 30 fps is too slow to see, scroll a few
+        offset = (self.frames * 4) % self.width
+        np.copyto(image, self._pattern[:, offset:offset + self.width])
+        cv2.putText(image, str(self.frames), (16, 48), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3, cv2.LINE_AA)
+        self.frames += 1
+        return True, image
+
+class FileSource:
+    """
+    A video file played as a camera: looped forever and paced at the set fps, at the
+    file's own size (picasso resizes it like any camera that does not match)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fps = 30.0
+        self._pacer = FramePacer(self.fps)
+        self._cap = cv2.VideoCapture(path)
+
+    def isOpened(self):
+        return self._cap.isOpened()
+
+    def release(self):
+        self._cap.release()
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FPS and value > 0:
+            self.fps = float(value)
+            self._pacer = FramePacer(self.fps)
+            return True
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return self._cap.get(prop)
+
+    def read(self, image=None):
+        self._pacer.wait()
+        ret, frame = self._cap.read(image)
+        if not ret:
+            # end of the file, start over
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self._cap.read(image)
+        return ret, frame
+
+class NullVirtualCamera:
+    """
+    Stands in for pyvirtualcam.Camera where there is no v4l2loopback device. pyvirtualcam
+    converts BGR to I420 before writing to the device, so this does the same conversion
+    into a reused buffer and the vcam stage still costs about what it does for real
+    """
+    def __init__(self, width, height, fps):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frames_sent = 0
+        self._buffer = np.empty((height * 3 // 2, width), dtype=np.uint8)
+
+    def send(self, frame: np.ndarray):
+        cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420, dst=self._buffer)
+        self.frames_sent += 1
+
+    def close(self):
+        pass
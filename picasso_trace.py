@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# the stages picasso records, in the order a frame goes through them
+STAGES = ("read", "handoff", "resize", "vcam", "preview_encode", "flush")
+
+class FrameTracer:
+    """
+    Opt-in per frame tracing (config "frame_tracing"). The capture thread stamps every
+    frame with its sequence number and time.monotonic() as it leaves the camera, later
+    stages record spans against that sequence number. Each span feeds a capture to stage
+    latency histogram and a bounded event buffer that exports as Chrome trace JSON (open
+    in chrome://tracing or ui.perfetto.dev). monotonic is CLOCK_MONOTONIC on linux, so
+    stamps taken in the capture process line up with the server's
+    """
+    def __init__(self, camera_id, latency_family, capacity=256, max_events=60000):
+        self.camera_id = camera_id
+        self.latency_family = latency_family
+        self._latency = {}
+        # capture stamps by seq % capacity, enough for frames still moving through the pipeline
+        self._seqs = np.full(capacity, -1, dtype=np.int64)
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._events = deque(maxlen=max_events) # (track, name, seq, start, end, since capture)
+        self._lock = threading.Lock()
+
+    def captured(self, seq, read_start, capture_time):
+        index = seq % len(self._seqs)
+        self._times[index] = capture_time
+        self._seqs[index] = seq
+        self._events.append(("capture", "read", seq, read_start, capture_time, 0.0))
+
+    def capture_time(self, seq):
+        index = seq % len(self._seqs)
+        if self._seqs[index] != seq:
+            return None # too old, or captured before tracing saw it
+        return float(self._times[index])
+
+    def span(self, stage, seq, start, end, track=None):
+        """
+        Records that stage worked on frame seq from start to end (monotonic seconds).
+        track is the row it shows up on in the trace, the stage itself by default
+        """
+        capture_time = self.capture_time(seq)
+        latency = end - capture_time if capture_time is not None else None
+        self._events.append((track or stage, stage, seq, start, end, latency))
+        if latency is None:
+            return
+        histogram = self._latency.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._latency.setdefault(stage, self.latency_family.labels(self.camera_id, stage))
+        histogram.observe(latency)
+
+    def stage_stats(self, since=0.0):
+        """
+        Per stage span count, duration and time since capture (p50/p95/p99/max in ms) of
+        the spans that started at or after since, what bench.py reports
+        """
+        durations = {}
+        latencies = {}
+        for track, name, seq, start, end, latency in list(self._events):
+            if start < since:
+                continue
+            durations.setdefault(name, []).append(end - start)
+            if latency is not None:
+                latencies.setdefault(name, []).append(latency)
+        return {name: {
+            "count": len(values),
+            "duration_ms": summarize_ms(values),
+            "since_capture_ms": summarize_ms(latencies.get(name, [])),
+        } for name, values in sorted(durations.items(), key=lambda item: STAGES.index(item[0]) if item[0] in STAGES else len(STAGES))}
+
+    def chrome_events(self, pid):
+        # complete ("X") events in microseconds, one thread row per track
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": f"camera {self.camera_id}"}}]
+        tids = {}
+        for track, name, seq, start, end, latency in list(self._events):
+            tid = tids.get(track)
+            if tid is None:
+                tid = tids[track] = len(tids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": track}})
+            args = {"seq": seq}
+            if latency is not None:
+                args["since_capture_ms"] = round(latency * 1000, 3)
+            events.append({
+                "name": name,
+                "cat": "frame",
+                "ph": "X",
+                "pid": pid,
+                "tid": tid,
+                "ts": round(start * 1e6, 1),
+                "dur": round(max(end - start, 0) * 1e6, 1),
+                "args": args,
+            })
+        return events
+
+def summarize_ms(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+    return {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3), "max": round(max(values) * 1000, 3)}
+
+def chrome_trace(tracers):
+    # one process row per camera
+    events = []
+    for pid, tracer in enumerate(tracers, start=1):
+        events += tracer.chrome_events(pid)
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"clock": "monotonic", "exported_at": time.monotonic()}}